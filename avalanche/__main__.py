@@ -16,7 +16,12 @@
 ################################################################################
 
 from __future__ import unicode_literals
-from .core import main
+import sys
 
-main()
+if sys.argv[1:2] == ["serve"]:
+    from .serve import main
+    main(sys.argv[2:])
+else:
+    from .core import main
+    main()
 
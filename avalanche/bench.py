@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# coding=utf-8
+################################################################################
+#
+# Description: Benchmarks for grammar parsing and generation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+################################################################################
+
+from __future__ import unicode_literals
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import timeit
+try:
+    import tracemalloc
+except ImportError: # python 2
+    tracemalloc = None
+
+from avalanche import Grammar, GenerationProfile, SparseList
+from avalanche.core import _GenState
+
+
+log = logging.getLogger("bench") # pylint: disable=invalid-name
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def best_of(func, number=1, repeat=5):
+    """Return the best time for a single call of func, in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def report(name, seconds, extra=""):
+    log.info("%-40s %12.3f ms %s", name, seconds * 1000, extra)
+
+
+def html_grammar(n_tags=200, n_props=500):
+    """Build a grammar resembling the DOM/CSS grammars used in practice: large flat choices, regexes, references
+       and recursion."""
+    rnd = random.Random(0)
+    lines = ["root        (element '\\n'){100}",
+             "element     '<' (tag) ' id=\"' id '\" style=\"' style{0,5} '\">' content{0,3} '</' @1 '>'",
+             "id          'id' /[0-9]{4}/",
+             "content  1  text",
+             "         1  element",
+             "         .5 '<a href=\"#' @id '\">' text '</a>'",
+             "text        /[A-Za-z ]{0,40}/",
+             "style       prop ':' value ';'",
+             "value    1  /[0-9]{1,3}/ ('px' | 'em' | '%')",
+             "         1  '#' /[a-f0-9]{6}/",
+             "         1  'rgb(' rndint(0,255) ',' rndint(0,255) ',' rndint(0,255) ')'"]
+    lines.append("tag      1  'tag0'")
+    lines.extend("         %0.2f  'tag%d'" % (rnd.random(), i) for i in range(1, n_tags))
+    lines.append("prop     1  'prop0'")
+    lines.extend("         %0.2f  'prop-%d'" % (rnd.random(), i) for i in range(1, n_props))
+    return "\n".join(lines)
+
+
+@benchmark
+def bench_parse():
+    gmr = html_grammar(2000, 5000)
+    report("parse (7000 choices)", best_of(lambda: Grammar(gmr)))
+
+
+@benchmark
+def bench_parse_long_line():
+    n = 20000
+    # one definition split over many lines with '\', as machine generated grammars often are
+    gmr = "root  " + " \\\n      ".join("'t%d' /[a-z]{1,3}/ rndint(0,%d) (a|b)" % (i, i) for i in range(n // 4)) + "\n" \
+          "a     'A'\n" \
+          "b     'B'\n"
+    took = best_of(lambda: Grammar(gmr))
+    report("parse (%d tokens on one line)" % n, took, "(%d tokens/s)" % (n / took))
+
+
+@benchmark
+def bench_parse_cached():
+    gmr = html_grammar(2000, 5000)
+    cache_dir = tempfile.mkdtemp(prefix="avalanche-bench")
+    try:
+        Grammar(gmr, cache_dir=cache_dir)
+        report("parse (7000 choices, cached)", best_of(lambda: Grammar(gmr, cache_dir=cache_dir)))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+@benchmark
+def bench_parse_import():
+    tmpd = tempfile.mkdtemp(prefix="avalanche-bench")
+    try:
+        with open(os.path.join(tmpd, "common.gmr"), "w") as fd:
+            fd.write(html_grammar(2000, 5000))
+        root = os.path.join(tmpd, "root.gmr")
+        with open(root, "w") as fd:
+            fd.write("common import('common.gmr')\n"
+                     "root   common.root\n")
+
+        def load():
+            with open(root) as fd:
+                return Grammar(fd)
+
+        def load_cold():
+            Grammar.clear_modules()
+            return load()
+
+        report("parse (7000 choices, imported)", best_of(load_cold))
+        report("parse (7000 choices, imported again)", best_of(load))
+    finally:
+        shutil.rmtree(tmpd)
+
+
+@benchmark
+def bench_generate():
+    gmr = Grammar(html_grammar())
+    report("generate (100KB limit)", best_of(gmr.generate, number=5))
+
+
+@benchmark
+def bench_profile():
+    gmr = Grammar(html_grammar())
+    report("generate (100KB limit, profiled)",
+           best_of(lambda: gmr.generate(seed=1, profile=GenerationProfile(gmr)), number=5),
+           "(%.1f ms unprofiled)" % (best_of(lambda: gmr.generate(seed=1), number=5) * 1000))
+
+
+@benchmark
+def bench_generate_regex():
+    gmr = Grammar("root   (hash ' ' color ' ' size ' ' ident '\\n'){1000}\n"
+                  "hash   /[a-f0-9]{32}/\n"
+                  "color  /#[0-9a-f]{6}/\n"
+                  "size   /[1-9][0-9]{0,2}/ ('px' | 'em')\n"
+                  "ident  /[A-Za-z_][A-Za-z0-9_]{0,15}/\n", limit=None)
+    report("generate (4000 regexes)", best_of(gmr.generate, number=5))
+    gmr = Grammar("root   line{100}\n"
+                  "line   /[a-z ]{1000}/ '\\n'\n", limit=None)
+    report("generate (100KB of [a-z ])", best_of(gmr.generate, number=5))
+
+
+class _CountingStack(list):
+    # symstack which counts iterations of the generation loop
+    pops = 0
+
+    def pop(self, *args):
+        self.pops += 1
+        return list.pop(self, *args)
+
+
+@benchmark
+def bench_optimize():
+
+    class Unoptimized(Grammar):
+        def optimize(self):
+            return {}
+
+    src = html_grammar()
+    for name, cls in (("unoptimized", Unoptimized), ("optimized", Grammar)):
+        gmr = cls(src)
+        gstate = _GenState(gmr)
+        gstate.reset(gmr._ids["root"], 1) # pylint: disable=protected-access
+        gstate.symstack = _CountingStack(gstate.symstack)
+        length = len(gmr._generate(gstate)) # pylint: disable=protected-access
+        report("generate (%s)" % name, best_of(lambda: gmr.generate(seed=1), number=5),
+               "(%d symbols, %.2f iterations/byte)" % (len(gmr.symtab), gstate.symstack.pops / length))
+
+
+@benchmark
+def bench_recursion():
+    n = 100
+    # many mutually recursive symbols, so many are open at once when the recursion limit is hit
+    lines = ["root   s0{20}"]
+    for i in range(n):
+        lines.append("s%d    1 '(' s%d s%d ')'" % (i, (i + 1) % n, (i + 7) % n))
+        lines.append("       1 '[' s%d ']'" % ((i + 3) % n))
+        lines.append("       .1 'x'")
+    gmr = Grammar("\n".join(lines), limit=None)
+    report("generate (%d recursive symbols)" % n, best_of(lambda: gmr.generate(seed=1), number=5))
+
+
+@benchmark
+def bench_repeat():
+    gmr = Grammar("root   item{1000,100000}\n"
+                  "item   'a' (/[0-9]/ | 'b')\n", limit=10000)
+    report("generate (item{1000,100000}, 10KB limit)", best_of(gmr.generate, number=5))
+
+
+def peak_memory(func):
+    """Return a description of the peak memory allocated by Python while running func()."""
+    if tracemalloc is None:
+        return "(peak memory needs python 3)"
+    tracemalloc.start()
+    try:
+        func()
+        return "(peak %.1f MB)" % (tracemalloc.get_traced_memory()[1] / 1e6)
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark
+def bench_generate_binary():
+    gmr = Grammar("root   item{100000}\n"
+                  "item   1 x'00'\n"
+                  "       1 x'ff41'\n"
+                  "       1 x'7f' x'80'\n", limit=None)
+    report("generate (binary, %d KB)" % (len(gmr.generate()) // 1024), best_of(gmr.generate),
+           peak_memory(gmr.generate))
+
+
+@benchmark
+def bench_references():
+    depth = 10
+    # every level is referenced, so each element is an instance nested in `depth` other instances
+    lines = ["root  (l0 '\\n'){2} %s" % " ".join("@l%d" % i for i in range(depth))]
+    for i in range(depth):
+        lines.append("l%d    '<' (/[a-z]{1,8}/) '>' l%d{2,3} '</' @1 '>'" % (i, i + 1))
+    lines.append("l%d    /[A-Za-z ]{0,40}/" % depth)
+    gmr = Grammar("\n".join(lines), limit=None)
+    report("generate (nested references, %d KB)" % (len(gmr.generate(seed=1)) // 1024),
+           best_of(lambda: gmr.generate(seed=1)), peak_memory(lambda: gmr.generate(seed=1)))
+
+
+@benchmark
+def bench_max_instances():
+    # a frequently referenced symbol in a large output keeps every instance alive unless capped
+    grammar = ("root   (id ' ' @id '\\n'){140000}\n"
+               "id     /[a-z]{4}/ /[0-9]{8}/ /[a-z]{8}/ /[0-9]{16}/\n")
+    for cap in (None, 100):
+        gmr = Grammar(grammar, limit=None, max_instances=cap)
+        size = len(gmr.generate(seed=1)) // (1024 * 1024)
+        report("generate (%d MB, max_instances=%r)" % (size, cap),
+               best_of(lambda: gmr.generate(seed=1), repeat=1), peak_memory(lambda: gmr.generate(seed=1)))
+
+
+@benchmark
+def bench_generate_many():
+    n = 10000
+    gmr = Grammar("root   (tag) '=' @id ' ' id\n"
+                  "id     'id' /[0-9]{4}/\n"
+                  "tag  1 'a'\n"
+                  "     1 'b'\n")
+    each = best_of(lambda: [gmr.generate() for _ in range(n)])
+    many = best_of(lambda: gmr.generate_many(n))
+    report("generate() x %d (small outputs)" % n, each, "(%d/s)" % (n / each))
+    report("generate_many(%d) (small outputs)" % n, many, "(%d/s)" % (n / many))
+
+
+@benchmark
+def bench_threads():
+    n = 400
+    gmr = Grammar(html_grammar(), limit=1000)
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+
+    def run(n_threads):
+        threads = [threading.Thread(target=lambda: [gmr.generate() for _ in range(n // n_threads)])
+                   for _ in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for n_threads in (1, 2, 4, 8):
+        took = best_of(lambda: run(n_threads))
+        report("generate() x %d in %d threads" % (n, n_threads), took,
+               "(%d/s%s)" % (n / took, ", GIL" if gil else ""))
+
+
+@benchmark
+def bench_splist():
+    n = 100000
+    rnd = random.Random(0)
+    for n_ranges in (10, 1000, 10000):
+        lst = SparseList()
+        for i in range(n_ranges):
+            lst.add(i * 10, i * 10 + 4)
+        keys = [rnd.randrange(len(lst)) for _ in range(n)]
+        took = best_of(lambda: [lst[key] for key in keys])
+        report("SparseList[i] x %d (%d ranges)" % (n, n_ranges), took, "(%d/s)" % (n / took))
+    ranges = [(i * 10, i * 10 + 4) for i in range(10000)]
+    rnd.shuffle(ranges)
+
+    def add_each():
+        lst = SparseList()
+        for a, b in ranges:
+            lst.add(a, b)
+
+    took = best_of(add_each)
+    report("SparseList.add() x %d" % len(ranges), took)
+    took = best_of(lambda: SparseList.from_ranges(ranges))
+    report("SparseList.from_ranges(%d)" % len(ranges), took)
+
+
+def main(argv=None):
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if bool(os.getenv("DEBUG")):
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    names = [func.__name__[len("bench_"):] for func in BENCHMARKS]
+    argp = argparse.ArgumentParser(description="Run avalanche benchmarks")
+    argp.add_argument("benchmark", nargs="*", help="Benchmarks to run (default: all): %s" % ", ".join(names))
+    args = argp.parse_args(argv)
+    for name in set(args.benchmark) - set(names):
+        argp.error("unknown benchmark: %s" % name)
+    for name, func in zip(names, BENCHMARKS):
+        if not args.benchmark or name in args.benchmark:
+            func()
+
+
+if __name__ == "__main__":
+    main()
@@ -23,22 +23,29 @@
 from __future__ import unicode_literals
 import argparse
 import binascii
+import bisect
 import codecs
 import hashlib
 import io
 import logging
+import multiprocessing
 import numbers
 import os
 import os.path
+import pickle
 import random
 import re
 import string
 import sys
+import tempfile
+import threading
+import timeit
 from .error import *
+from .fenwick import FenwickSampler
 from .splist import SparseList
 
 
-__all__ = ("Grammar", "GrammarException", "ParseError", "IntegrityError", "GenerationError",
+__all__ = ("Grammar", "GrammarException", "ParseError", "IntegrityError", "GenerationError", "GenerationProfile",
            "BinSymbol", "ChoiceSymbol", "ConcatSymbol", "FuncSymbol", "RefSymbol", "RepeatSymbol",
            "RepeatSampleSymbol", "RegexSymbol", "SparseList", "TextSymbol", "unichr_")
 
@@ -65,25 +72,171 @@ def _file_to_unicode(fd):
     return fd
 
 
+def _hash_file(fd):
+    """Return the sha512 hex digest of a unicode file object, leaving it at the start."""
+    result = hashlib.sha512()
+    while True:
+        hash_str = fd.read(4096)
+        result.update(hash_str.encode("utf-8"))
+        if len(hash_str) < 4096:
+            break
+    fd.seek(0)
+    return result.hexdigest()
+
+
 DEFAULT_LIMIT = 100 * 1024
+CACHE_VERSION = 7 # increment when the format of cached grammars, or the output for a given seed changes
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# opcodes of the compiled generation plan (see Grammar.compile)
+_OP_CALL = 0   # call the symbol's generate() method
+_OP_TEXT = 1   # append a constant value to the output
+_OP_CONCAT = 2 # push a tuple of child ids (already reversed) onto the symstack
+
+# flags of the compiled generation plan
+_FLAG_NAMED = 1     # explicitly named symbol, opens a new backreference scope
+_FLAG_TRACKED = 2   # instances of this symbol are captured for references
+_FLAG_RECURSIVE = 4 # symbol is recursive, depth is limited during generation
+_FLAG_BACKREF = 8   # tracked implicit concat, instances are stored in the backreference scope
 
 
 log = logging.getLogger("avalanche") # pylint: disable=invalid-name
 
 
+def _rndint(rng, a, b):
+    return str(rng.randint(int(a), int(b)))
+
+
+def _rndpow2(rng, a, b):
+    return str(max(2 ** rng.randint(0, int(a)) + rng.randint(-int(b), int(b)), 0))
+
+
+def _rndflt(rng, a, b):
+    return str(rng.uniform(float(a), float(b)))
+
+
+def _rndtext(rng, table, delete, k):
+    """Return `k` random latin-1 characters, drawn in bulk as random bytes mapped through a translation table.
+       Bytes in `delete` are dropped so every character in the table is equally likely, see RegexSymbol.compile().
+    """
+    accept = 256 - len(delete)
+    out = b""
+    while len(out) < k:
+        n_bytes = (k - len(out)) * 256 // accept + 1
+        data = binascii.unhexlify("%0*x" % (2 * n_bytes, rng.getrandbits(8 * n_bytes)))
+        out += data.translate(table, delete)
+    return out[:k].decode("latin-1")
+
+
+# built-in functions which use the generation RNG, these are called with it as the first argument
+_RNG_FUNCS = {"rndint": _rndint, "rndpow2": _rndpow2, "rndflt": _rndflt}
+
+
+_NOTHING = object() # marks symbols which generate nothing at all in Grammar.fold_constants()
+_WORKER_GRAMMAR = None # Grammar used by generate_parallel() worker processes
+_MODULES = {} # sha512 -> _ParsedModule for every grammar imported in this process, see Grammar.link()
+
+
+def _parallel_init(grmr):
+    global _WORKER_GRAMMAR # pylint: disable=global-statement,invalid-name
+    _WORKER_GRAMMAR = grmr
+
+
+def _parallel_generate(task):
+    idx, start, seed = task
+    try:
+        return idx, _WORKER_GRAMMAR.generate(start, seed=seed)
+    except GrammarException as err:
+        # the exception locals can't be pickled back to the parent, so send the formatted message only
+        exc = GenerationError("%s (testcase %d)" % (err, idx))
+        exc.raise_locals = {}
+        raise exc
+
+
+class _ParsedModule(object):
+    """Symbols parsed from one imported grammar file, before they are renamed and compiled by the importing Grammar.
+       Each Grammar which imports the same file gets copies of the symbols, which share all parsed values.
+    """
+
+    def __init__(self, pstate):
+        self.imports = pstate.import_lines # (name, filename, sha512) of each import in the file
+        symtab = pstate.grmr.symtab
+        # symbols can be removed from the symtab after being added (eg. numeric function args)
+        # placeholders for symbols of other files are left out, with circular imports they can be created before the
+        # other file defines them, and would replace the definition when linked
+        own = "%s." % pstate.prefix
+        self.symbols = {name: sym.copy() for (name, sym) in pstate.symbols.items()
+                        if symtab.get(name) is sym and (name.startswith(own) or not isinstance(sym, _AbstractSymbol))}
+        self.tracked = {sym.ref for sym in self.symbols.values() if isinstance(sym, RefSymbol)}
+
+
+class _Instance(object):
+    """A generated instance of a tracked symbol, kept as offsets into the output it was generated in until its value
+       is needed (which may be never).
+    """
+    __slots__ = ("output", "start", "end", "value")
+
+    def __init__(self, output, start, end):
+        self.output = output
+        self.start = start
+        self.end = end
+        self.value = None
+
+    def get(self, gstate):
+        if self.value is None:
+            self.value = gstate.join(self.output[self.start:self.end])
+            self.output = None
+        return self.value
+
+
 class _GenState(object):
 
     def __init__(self, grmr):
+        # pylint: disable=protected-access
         self.symstack = []
-        self.instances = {}
-        self.instance_backlog = {}
-        self.output = []
+        self.instances = {grmr._ids[sym]: [] for sym in grmr.tracked}
+        self.instance_backlog = {grmr._ids[sym]: [] for sym in grmr.tracked}
+        self.max_instances = grmr.max_instances
+        self.n_instances = {} # number of instances generated for each tracked symbol, if max_instances is set
+        # the output type is decided by Grammar.compile(): binary output is written to a bytearray, and text to a list
+        # of fragments. if the grammar can generate either, the type of each fragment is checked.
+        self.output_type = grmr._output_type
+        self.new_output = bytearray if self.output_type is bytes else list
+        if self.output_type is bytes:
+            self.append = self._append_bytes
+        elif self.output_type is str:
+            self.append = self._append_text
+        self.output = self.new_output()
         self.grmr = grmr
+        self.trace = grmr._trace
+        self.rng = None
         self.length = 0
         self.backrefs = []
         self.choice_stack = {}
         self.recursive_syms = {}
+        self.n_limited = 0 # number of recursive_syms which are "limited", see Grammar.is_limit_exceeded()
         self.id = 0
+        self.profile = None # GenerationProfile to record into, if any
+
+    def reset(self, start, seed=None):
+        # prepare for generating a new output from symbol id `start`, reusing the existing containers
+        # seeding is relatively slow (~10us), so without a seed the grammar RNG for this thread is used as is
+        self.rng = self.grmr.thread_rng() if seed is None else random.Random(seed)
+        self.symstack[:] = [start]
+        for instances in self.instances.values():
+            del instances[:]
+        for instances in self.instance_backlog.values():
+            del instances[:]
+        self.n_instances.clear()
+        self.output = self.new_output()
+        self.length = 0
+        del self.backrefs[:]
+        self.choice_stack.clear()
+        self.recursive_syms.clear()
+        self.n_limited = 0
+        self.id = 0
+        if self.profile is not None:
+            self.profile.begin()
 
     def append(self, value):
         if self.output and not isinstance(value, type(self.output[0])):
@@ -92,8 +245,47 @@ class _GenState(object):
         self.output.append(value)
         self.length += len(value)
 
+    def _append_text(self, value):
+        self.output.append(value)
+        self.length += len(value)
+
+    def _append_bytes(self, value):
+        self.output += value
+        self.length += len(value)
+
+    def join(self, output):
+        # return the value of `output`, or a slice of it
+        if self.output_type is str:
+            return "".join(output)
+        if self.output_type is bytes:
+            return bytes(output)
+        try:
+            return "".join(output)
+        except TypeError:
+            return b"".join(output)
+
+    def flush(self):
+        # return everything generated since the last flush, and start a new output
+        output, self.output = self.output, self.new_output()
+        return self.join(output)
+
+    def add_instance(self, sym, instance):
+        instances = self.instances[sym]
+        if self.max_instances is None:
+            instances.append(instance)
+            return
+        # reservoir sampling: every instance generated so far is equally likely to be kept
+        seen = self.n_instances[sym] = self.n_instances.get(sym, 0) + 1
+        if len(instances) < self.max_instances:
+            instances.append(instance)
+        else:
+            idx = self.rng.randrange(seen)
+            if idx < self.max_instances:
+                instances[idx] = instance
+
     def backtrace(self):
-        return ", ".join(sym[1] for sym in self.symstack if sym[0] == 'unwind')
+        names = self.grmr._names # pylint: disable=protected-access
+        return ", ".join(names[~sym] for sym in self.symstack if not isinstance(sym, tuple) and sym < 0)
 
     def generate_id(self):
         result = "%d" % self.id
@@ -101,15 +293,128 @@ class _GenState(object):
         self.append(result)
 
 
+class GenerationProfile(object):
+    """Per-symbol statistics recorded while generating from a Grammar (see Grammar.profile()).
+
+       For each symbol, stats() gives the number of times it was generated (`count`), the length of output it generated
+       (`length`, in characters or bytes for binary output) and the time taken in seconds (`time`). These include the
+       symbols it generated in turn, and `self_length`/`self_time` exclude them. Lengths are counted as for the limit,
+       so they include function arguments, which are generated but passed to the function instead of the output.
+
+       A profile can be passed to several generations and holds the totals, but must only be used by one at a time.
+    """
+    timer = staticmethod(timeit.default_timer)
+
+    def __init__(self, grmr):
+        # pylint: disable=protected-access
+        self.names = grmr._names
+        n_syms = len(self.names)
+        self.counts = [0] * n_syms
+        self.lengths = [0] * n_syms
+        self.self_lengths = [0] * n_syms
+        self.times = [0.0] * n_syms
+        self.self_times = [0.0] * n_syms
+        self._active = [0] * n_syms # open frames of each symbol, so recursive symbols are only counted once in `time`
+        # every distinct chain of open symbols (as in _GenState.backtrace()) is a path, for collapsed()
+        self._paths = {} # (parent path, symbol id) -> path id
+        self._path_keys = [] # path id -> (parent path, symbol id)
+        self._path_lengths = []
+        self._path_times = []
+        # open symbols, each [symbol id, path id, start time, start length, time in children, length in children]
+        self._frames = []
+        self._paused = None
+
+    def begin(self):
+        # start a new output, called by _GenState.reset(). nested generation (eg. function args) shares the frames
+        self._frames = [[None, -1, 0.0, 0, 0.0, 0]]
+        for sym in range(len(self._active)):
+            self._active[sym] = 0
+
+    def enter(self, sym, length):
+        key = (self._frames[-1][1], sym)
+        path = self._paths.get(key)
+        if path is None:
+            path = self._paths[key] = len(self._path_keys)
+            self._path_keys.append(key)
+            self._path_lengths.append(0)
+            self._path_times.append(0.0)
+        self._active[sym] += 1
+        self._frames.append([sym, path, self.timer(), length, 0.0, 0])
+
+    def exit(self, length):
+        sym, path, start, start_length, child_time, child_length = self._frames.pop()
+        elapsed = self.timer() - start
+        generated = length - start_length
+        parent = self._frames[-1]
+        parent[4] += elapsed
+        parent[5] += generated
+        self.counts[sym] += 1
+        self.self_lengths[sym] += generated - child_length
+        self.self_times[sym] += elapsed - child_time
+        self._path_lengths[path] += generated - child_length
+        self._path_times[path] += elapsed - child_time
+        self._active[sym] -= 1
+        if not self._active[sym]:
+            self.lengths[sym] += generated
+            self.times[sym] += elapsed
+
+    def pause(self):
+        # stop the clock while a chunk is handled outside of generation
+        self._paused = self.timer()
+
+    def resume(self):
+        delta = self.timer() - self._paused
+        for frame in self._frames[1:]:
+            frame[2] += delta
+
+    def stats(self):
+        """Return a dict of symbol name -> {"count", "length", "self_length", "time", "self_time"} for every symbol
+           which was generated.
+        """
+        return {self.names[sym]: {"count": self.counts[sym], "length": self.lengths[sym],
+                                  "self_length": self.self_lengths[sym], "time": self.times[sym],
+                                  "self_time": self.self_times[sym]}
+                for sym in range(len(self.names)) if self.counts[sym]}
+
+    def report(self, limit=None):
+        """Return a table of symbol stats as text, sorted by self_time (longest first)."""
+        stats = sorted(self.stats().items(), key=lambda item: (-item[1]["self_time"], item[0]))
+        lines = ["%10s %12s %12s %10s %10s  %s" % ("count", "length", "self_length", "time_ms", "self_ms", "symbol")]
+        for name, stat in stats[:limit]:
+            lines.append("%10d %12d %12d %10.3f %10.3f  %s" % (stat["count"], stat["length"], stat["self_length"],
+                                                              stat["time"] * 1000, stat["self_time"] * 1000, name))
+        return "\n".join(lines) + "\n"
+
+    def collapsed(self, weight="time"):
+        """Return stacks in the collapsed format read by flamegraph tools: one line for each chain of symbols, from
+           the start symbol to the one generating, followed by its self time in microseconds (or self length if
+           `weight` is "length").
+        """
+        if weight == "time":
+            values = [int(round(value * 1e6)) for value in self._path_times]
+        elif weight == "length":
+            values = self._path_lengths
+        else:
+            raise ValueError("Unknown weight: %s" % weight)
+        chains = []
+        for parent, sym in self._path_keys:
+            # parents are always created before their children
+            chains.append((chains[parent] + ";" if parent >= 0 else "") + self.names[sym])
+        return "".join("%s %d\n" % (chain, value) for chain, value in sorted(zip(chains, values)) if value)
+
+
 class _ParseState(object):
 
     def __init__(self, prefix, grmr, filename):
         self.prefix = prefix
         self.imports = {} # friendly name -> (grammar hash, import line_no)
         self.imports_used = set() # friendly names used by get_prefixed()
+        self.import_lines = [] # (friendly name, filename, sha512) of each import, in order
+        self.symbols = {} # symbols added to the symtab while parsing this file
         self.line_no = 0
         self.n_implicit = -1
         self.grmr = grmr
+        self.trace = grmr._trace # pylint: disable=protected-access
         self.name = filename
         self.capture_groups = []
 
@@ -174,6 +479,12 @@ class Grammar(object):
        Imports allow you to break up grammars into multiple files. A grammar which imports another assigns it a local
        name ``ModuleName``, which may be used to access symbols from that grammar such as ``ModuleName.Symbol``, etc.
        Everything should work as expected, including references. Modules must be imported before they can be used.
+
+       Once created, a Grammar is not modified by generation, so it is safe to generate from several threads at once
+       (as long as any functions passed to the Grammar are also thread-safe).
+
+       Every instance of a referenced symbol is kept for the whole generation by default. If `max_instances` is given,
+       at most that many are kept for each symbol, as a uniform random sample of all instances generated so far.
     """
     _RE_LINE = re.compile(r"""^((?P<broken>.*)\\
                                 |\s*(?P<comment>\#).*
@@ -187,19 +498,35 @@ class Grammar(object):
                                 |\s+(\+|(?P<contweight>(\d*\.)?\d+(e-?\d+)?))\s*(?P<cont>.+))$
                            """, re.VERBOSE)
 
-    def __init__(self, grammar, limit=DEFAULT_LIMIT, **kwargs):
+    def __init__(self, grammar, limit=DEFAULT_LIMIT, cache_dir=None, max_instances=None, **kwargs):
         self._limit = limit
+        if max_instances is not None and max_instances < 1:
+            raise IntegrityError("max_instances must be at least 1, got %r" % max_instances)
+        self.max_instances = max_instances
+        self.rng = random.Random() # used for generation when no seed is given
+        self._local = threading.local() # per-thread state, see thread_rng()
+        self._local.rng = self.rng
+        self._hashes = [] # sha512 of the grammar and each import, in the order parsed
+        self._import_files = [] # (paths tried, index of the path used, sha512) for each import, see load_cache()
+        self._funcs_used = set()
+        # decide once whether to log in loops over every line/token/symbol, so it costs nothing when disabled
+        self._trace = log.isEnabledFor(logging.DEBUG)
         self.symtab = {}
         self.tracked = set()
         self.funcs = kwargs
         self.recursive_syms = set()
-        if "rndint" not in self.funcs:
-            self.funcs["rndint"] = lambda a, b: str(random.randint(int(a), int(b)))
-        if "rndpow2" not in self.funcs:
-            self.funcs["rndpow2"] = lambda a, b: str(max(2 ** random.randint(0, int(a))
-                                                         + random.randint(-int(b), int(b)), 0))
-        if "rndflt" not in self.funcs:
-            self.funcs["rndflt"] = lambda a, b: str(random.uniform(float(a), float(b)))
+        self.optimize_stats = {} # what optimize() changed, see there
+        # compiled generation plan, indexed by symbol id (see compile())
+        self._ids = {}
+        self._names = []
+        self._syms = []
+        self._ops = []
+        self._args = []
+        self._flags = []
+        self._output_type = str
+        for func in _RNG_FUNCS:
+            if func not in self.funcs:
+                self.funcs[func] = None # special case in FuncSymbol.generate
         if "eval" not in self.funcs:
             self.funcs["eval"] = None # eval is a special case in FuncSymbol.generate
         if "id" not in self.funcs:
@@ -214,51 +541,196 @@ class Grammar(object):
         else:
             grammar = io.StringIO(grammar)
 
+        grammar_hash = _hash_file(grammar)
+        cache_fn = None
+        if cache_dir is not None:
+            cache_fn = self.cache_path(cache_dir, grammar_hash, getattr(grammar, "name", None))
+            if self.load_cache(cache_fn):
+                return
+
         # Initial definitions use hash of the grammar as the prefix, keeping track of the first used friendly name
         # ("" for top level). When grammar and imports are fully parsed, do a final pass to rename hash prefixes to
         # friendly prefixes.
 
         imports = {} # hash -> friendly prefix
-        self.parse(grammar, imports)
+        self.parse(grammar, imports, full_hash=grammar_hash)
+        # (hash, seed) identifies an output. the python major version is included since the random module generates
+        # different values from the same seed in python 2 and 3
+        hash_key = "%d:%d:%s:%r" % (CACHE_VERSION, sys.version_info[0], ":".join(self._hashes), limit)
+        if max_instances is not None:
+            hash_key += ":%d" % max_instances # changes which instances references choose from
+        self.hash = hashlib.sha512(hash_key.encode("ascii")).hexdigest()
         self.reprefix(imports)
         self.sanity_check()
         self.normalize()
         self.check_termination()
+        self.optimize()
+        self.compile()
+        if cache_fn is not None:
+            self.save_cache(cache_fn)
+
+    def cache_path(self, cache_dir, grammar_hash, grammar_fn):
+        """Return the path in `cache_dir` for a grammar with the given hash and filename.
+           Imports are resolved relative to the grammar file and the working directory, so both are part of the key.
+        """
+        key = "%d:%d.%d:%s:%s:%s:%r:%r" % (CACHE_VERSION, sys.version_info[0], sys.version_info[1], grammar_hash,
+                                           os.path.dirname(grammar_fn) if grammar_fn is not None else "", os.getcwd(),
+                                           self._limit, self.max_instances)
+        return os.path.join(cache_dir, "%s.gmrc" % hashlib.sha512(key.encode("utf-8")).hexdigest()[:32])
+
+    def load_cache(self, cache_fn):
+        """Load the compiled grammar from `cache_fn`, if it exists and all imports are unchanged.
+           Returns True if the cache was used. Cache files are pickles, so only use a cache directory you trust.
+        """
+        try:
+            with open(cache_fn, "rb") as cache_fd:
+                state = pickle.load(cache_fd)
+        except (IOError, OSError):
+            return False
+        except Exception as exc: # pylint: disable=broad-except
+            log.warning("ignoring unreadable grammar cache %s: %s", cache_fn, exc)
+            return False
+        if not isinstance(state, dict) or state.pop("_cache_version", None) != CACHE_VERSION:
+            return False
+        for import_paths, index, import_hash in state["_import_files"]:
+            for i, import_fn in enumerate(import_paths):
+                try:
+                    with io.open(import_fn, encoding="utf-8") as import_fd:
+                        if i != index or _hash_file(import_fd) != import_hash:
+                            log.debug("grammar cache %s is stale: %s changed", cache_fn, import_fn)
+                            return False
+                    break
+                except IOError:
+                    pass
+            else:
+                return False
+        self._check_funcs(state["_funcs_used"])
+        self.__dict__.update(state)
+        self._output_type = self._find_output_type() # depends on the functions passed to this Grammar
+        log.debug("loaded grammar from cache %s", cache_fn)
+        return True
+
+    def save_cache(self, cache_fn):
+        """Save the compiled grammar to `cache_fn`. Functions passed to the Grammar are not saved."""
+        state = self.__getstate__()
+        for attr in ("funcs", "rng", "_trace", "_output_type"):
+            del state[attr]
+        state["_cache_version"] = CACHE_VERSION
+        cache_dir = os.path.dirname(cache_fn)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_fd, tmp_fn = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(tmp_fd, "wb") as cache_fd:
+                    pickle.dump(state, cache_fd, pickle.HIGHEST_PROTOCOL)
+                if hasattr(os, "replace"):
+                    os.replace(tmp_fn, cache_fn) # atomic, concurrent loaders see the old file or the new one
+                else:
+                    # python 2: rename() can't overwrite on Windows, so a concurrent loader may briefly find no cache
+                    if sys.platform == "win32" and os.path.exists(cache_fn):
+                        os.unlink(cache_fn)
+                    os.rename(tmp_fn, cache_fn)
+            except BaseException:
+                os.unlink(tmp_fn)
+                raise
+        except (IOError, OSError, pickle.PicklingError) as exc:
+            log.warning("failed to write grammar cache %s: %s", cache_fn, exc)
 
-    def parse(self, grammar, imports, prefix=""):
-        grammar_hash = hashlib.sha512()
-        while True:
-            hash_str = grammar.read(4096)
-            grammar_hash.update(hash_str.encode("utf-8"))
-            if len(hash_str) < 4096:
-                break
-        grammar_hash = grammar_hash.hexdigest()[:6]
+    @staticmethod
+    def clear_modules():
+        """Forget all imported grammars kept for reuse by later Grammars in this process."""
+        _MODULES.clear()
+
+    @staticmethod
+    def _import_paths(import_fn, grammar_fn):
+        # resolve import_fn from current grammar path or "."
+        import_paths = [import_fn]
+        if grammar_fn is not None:
+            import_paths.insert(0, os.path.join(os.path.dirname(grammar_fn), import_fn))
+        return tuple(import_paths)
+
+    def _import(self, import_fn, grammar_fn, imports, prefix, expected_hash=None):
+        """Find and parse an imported grammar. Returns (grammar hash, sha512), or None if `expected_hash` is given and
+           the file found doesn't match.
+        """
+        import_paths = self._import_paths(import_fn, grammar_fn)
+        for i, path in enumerate(import_paths):
+            try:
+                with io.open(path, encoding='utf-8') as import_fd:
+                    import_fd = _file_to_unicode(import_fd)
+                    full_hash = _hash_file(import_fd)
+                    if expected_hash is not None and full_hash != expected_hash:
+                        return None
+                    self._import_files.append((import_paths, i, full_hash))
+                    return self.parse(import_fd, imports, prefix=prefix, full_hash=full_hash), full_hash
+            except IOError:
+                pass
+        raise IntegrityError("Could not find imported grammar: %s" % import_fn)
+
+    def link(self, module, grammar_fn, imports, prefix):
+        """Add the symbols of a previously parsed grammar file to the symtab, instead of parsing it again.
+           Returns False if any of its imports resolve to different files from when it was parsed.
+        """
+        for _, import_fn, import_hash in module.imports:
+            for path in self._import_paths(import_fn, grammar_fn):
+                try:
+                    with io.open(path, encoding='utf-8') as import_fd:
+                        if _hash_file(import_fd) != import_hash:
+                            return False
+                    break
+                except IOError:
+                    pass
+            else:
+                return False
+        for name, import_fn, import_hash in module.imports:
+            import_prefix = "%s.%s" % (prefix, name) if prefix else name
+            if self._import(import_fn, grammar_fn, imports, import_prefix, expected_hash=import_hash) is None:
+                raise IntegrityError("Imported grammar changed while loading: %s" % import_fn)
+        for name, sym in module.symbols.items():
+            self.symtab[name] = sym.copy()
+        self.tracked |= module.tracked
+        return True
+
+    def parse(self, grammar, imports, prefix="", full_hash=None):
+        if full_hash is None:
+            full_hash = _hash_file(grammar)
+        grammar_hash = full_hash[:6]
         grammar_fn = getattr(grammar, "name", None)
         if grammar_hash in imports:
             return grammar_hash
-        log.debug("parsing new grammar %r:%s (%s)", grammar_fn, grammar_hash, prefix)
+        self._hashes.append(full_hash)
         imports[grammar_hash] = prefix
-        grammar.seek(0)
+        module = _MODULES.get(full_hash)
+        if module is not None and self.link(module, grammar_fn, imports, prefix):
+            log.debug("reused parsed grammar %r:%s (%s)", grammar_fn, grammar_hash, prefix)
+            return grammar_hash
+        log.debug("parsing new grammar %r:%s (%s)", grammar_fn, grammar_hash, prefix)
         pstate = _ParseState(grammar_hash, self, grammar_fn)
 
         try:
             sym = None
-            ljoin = ""
+            ljoin = []
             for line in grammar:
                 pstate.line_no += 1
                 pstate.n_implicit = -1
-                log.debug("parsing line # %d: %s", pstate.line_no, line.rstrip())
+                if pstate.trace:
+                    log.debug("parsing line # %d: %s", pstate.line_no, line.rstrip())
                 # allow commented out lines anywhere, even between broken lines
                 if line.lstrip().startswith("#"):
                     continue
-                match = Grammar._RE_LINE.match("%s%s" % (ljoin, line))
-                if match is None:
-                    raise ParseError("Failed to parse definition at: %s%s" % (ljoin, line.rstrip()))
-                if match.group("broken") is not None:
-                    ljoin = match.group("broken")
+                if line.endswith("\\\n") or line.endswith("\\"):
+                    # same as the 'broken' group of _RE_LINE
+                    ljoin.append(line[:-2] if line.endswith("\n") else line[:-1])
                     continue
+                if ljoin:
+                    ljoin.append(line)
+                    line = "".join(ljoin)
+                    ljoin = []
+                match = Grammar._RE_LINE.match(line)
+                if match is None:
+                    raise ParseError("Failed to parse definition at: %s" % line.rstrip())
                 pstate.capture_groups = []
-                ljoin = ""
                 if match.group("comment") or match.group("nothing") is not None:
                     continue
                 if match.group("name"):
@@ -274,28 +746,17 @@ class Grammar(object):
                         if "%s.%s" % (grammar_hash, sym_name) in self.symtab:
                             raise ParseError("Redefinition of symbol %s previously declared on line %d"
                                              % (sym_name, self.symtab["%s.%s" % (grammar_hash, sym_name)].line_no))
-                        sym, defn = TextSymbol.parse(sym_def, pstate, no_add=True)
-                        defn = defn.strip()
+                        sym, pos = TextSymbol.parse(sym_def, 0, pstate, no_add=True)
+                        defn = sym_def[pos:].strip()
                         if not defn.startswith(")"):
                             raise ParseError("Expected ')' parsing import at: %s" % defn)
                         defn = defn[1:].lstrip()
                         if defn.startswith("#") or defn:
                             raise ParseError("Unexpected input following import: %s" % defn)
-                        # resolve sym.value from current grammar path or "."
-                        import_paths = [sym.value]
-                        if grammar_fn is not None:
-                            import_paths.insert(0, os.path.join(os.path.dirname(grammar_fn), sym.value))
-                        for import_fn in import_paths:
-                            try:
-                                with io.open(import_fn, encoding='utf-8') as import_fd:
-                                    import_prefix = "%s.%s" % (prefix, sym_name) if prefix else sym_name
-                                    import_hash = self.parse(_file_to_unicode(import_fd), imports, prefix=import_prefix)
-                                    pstate.add_import(sym_name, import_hash)
-                                break
-                            except IOError:
-                                pass
-                        else:
-                            raise IntegrityError("Could not find imported grammar: %s" % sym.value)
+                        import_prefix = "%s.%s" % (prefix, sym_name) if prefix else sym_name
+                        import_hash, full_import_hash = self._import(sym.value, grammar_fn, imports, import_prefix)
+                        pstate.add_import(sym_name, import_hash)
+                        pstate.import_lines.append((sym_name, sym.value, full_import_hash))
                     else:
                         # sym def
                         sym = ConcatSymbol.parse(sym_name, sym_def, pstate)
@@ -311,6 +772,8 @@ class Grammar(object):
             raise
         except Exception as err:
             raise ParseError("%s: %s" % (type(err).__name__, str(err)))
+        if prefix:
+            _MODULES[full_hash] = _ParsedModule(pstate)
         return grammar_hash
 
     def reprefix(self, imports):
@@ -328,7 +791,7 @@ class Grammar(object):
             except KeyError:
                 raise ParseError("Failed to reassign %s to proper namespace after parsing" % symname)
             newname = "".join((newprefix, "." if newprefix else "", name))
-            if symname != newname:
+            if symname != newname and self._trace:
                 log.debug('reprefixed %s -> %s', symname, newname)
             return "".join(("@" if ref else "", newname))
 
@@ -345,8 +808,8 @@ class Grammar(object):
                 del self.symtab[oldname]
             sym.map(get_prefixed)
             if isinstance(sym, FuncSymbol) and sym.fname == "eval":
-                prefix = sym.imports.prefix
-                sym.imports = {prefix: imports[hash_] for (prefix, (hash_, _)) in sym.imports.imports.items()}
+                prefix, scope = sym.imports
+                sym.imports = {prefix: imports[hash_] for (prefix, (hash_, _)) in scope.items()}
                 sym.imports[""] = imports[prefix]
                 log.debug("preserving imports for eval in %s: %r", sym.name, sym.imports)
         self.tracked = {get_prefixed(t) for t in self.tracked}
@@ -360,6 +823,142 @@ class Grammar(object):
                 continue # can happen if symbol is optimized out
             sym.normalize(self)
 
+    def optimize(self):
+        """Simplify the symbol tree after check_termination(), without changing what is generated for a given seed.
+           Returns counts of what was changed, which are also kept in `optimize_stats`.
+        """
+        n_symbols = len(self.symtab)
+        self.optimize_stats = {"folded": self.fold_constants()}
+        self.optimize_stats.update(self.inline_concats())
+        self.optimize_stats["removed"] = self.remove_unreachable()
+        self.optimize_stats["symbols"] = (n_symbols, len(self.symtab))
+        log.debug("optimized grammar: %r", self.optimize_stats)
+        return self.optimize_stats
+
+    def fold_constants(self):
+        """Replace every symbol which always generates the same value with a single TextSymbol or BinSymbol of the
+           same name. Symbols tracked for references or capture groups are kept, since their instances are needed.
+           Returns the number of symbols folded.
+        """
+        values = {} # name -> constant value, _NOTHING if the symbol generates nothing, or None if it isn't constant
+
+        def value_of(name):
+            if name in values:
+                return values[name]
+            values[name] = None # also stops recursion
+            sym = self.symtab[name]
+            value = None
+            if name in self.tracked:
+                pass
+            elif isinstance(sym, (TextSymbol, BinSymbol)):
+                value = sym.value
+            elif type(sym) is RepeatSymbol and sym.min_ == sym.max_ == 0: # pylint: disable=unidiomatic-typecheck
+                value = _NOTHING
+            elif type(sym) in (ConcatSymbol, RegexSymbol) \
+                    or (type(sym) is RepeatSymbol and sym.min_ == sym.max_): # pylint: disable=unidiomatic-typecheck
+                parts = [value_of(child) for child in sym]
+                if None not in parts:
+                    # children which generate nothing are dropped, an empty str would be the wrong type for binary
+                    parts = [part for part in parts if part is not _NOTHING]
+                    if not parts:
+                        value = _NOTHING
+                    elif len({type(part) for part in parts}) == 1:
+                        value = parts[0][:0].join(parts)
+                        if isinstance(sym, RepeatSymbol):
+                            value *= sym.min_
+                        if not value and isinstance(sym, RegexSymbol):
+                            value = _NOTHING # an empty regex doesn't generate anything, even "" (see generate())
+            values[name] = value
+            return value
+
+        folded = 0
+        for name in list(self.symtab):
+            sym = self.symtab[name]
+            if isinstance(sym, (TextSymbol, BinSymbol)) or value_of(name) in (None, _NOTHING):
+                continue
+            value = values[name]
+            cls = BinSymbol if isinstance(value, bytes) else TextSymbol
+            result = cls.__new__(cls)
+            result.name, result.line_no, result.value, result.can_terminate = name, sym.line_no, value, True
+            self.symtab[name] = result
+            if self._trace:
+                log.debug("folded %s to %r", name, value)
+            folded += 1
+        return folded
+
+    def _is_inlinable(self, name):
+        # implicit concats can be replaced by their children, unless their instances are needed
+        # pylint: disable=unidiomatic-typecheck
+        return "[" in name and type(self.symtab[name]) is ConcatSymbol and name not in self.tracked
+
+    def inline_concats(self):
+        """Replace references to implicit concats which have a single child with the child, and splice the children
+           of implicit concats into parent concats and repeats. Each saves a symstack step per generation.
+           Returns the number of references "inlined" and "flattened".
+        """
+        stats = {"inlined": 0, "flattened": 0}
+
+        def resolve(name):
+            # follow single child implicit concats
+            while self._is_inlinable(name) and len(self.symtab[name]) == 1:
+                name = self.symtab[name][0]
+                stats["inlined"] += 1
+            return name
+
+        def flatten(children):
+            result = []
+            for child in children:
+                child = resolve(child)
+                if self._is_inlinable(child):
+                    result.extend(flatten(self.symtab[child]))
+                    stats["flattened"] += 1
+                else:
+                    result.append(child)
+            return result
+
+        for sym in list(self.symtab.values()):
+            # pylint: disable=unidiomatic-typecheck
+            if type(sym) in (ConcatSymbol, RepeatSymbol, RepeatSampleSymbol):
+                children = flatten(sym)
+                if children != list(sym):
+                    list.__init__(sym, children)
+            elif isinstance(sym, ChoiceSymbol):
+                # '+' choices need the concat, for its .choice
+                sym.values = [value if was_plus else resolve(value)
+                              for (value, was_plus) in zip(sym.values, sym.was_plus)]
+            elif isinstance(sym, FuncSymbol):
+                sym.map(resolve)
+        return stats
+
+    def remove_unreachable(self):
+        """Remove symbols which can't be generated from any top-level named symbol, such as unused symbols from
+           imports and implicit symbols replaced by fold_constants() and inline_concats(). Top-level symbols are kept,
+           so any of them can be a start symbol. If the grammar uses eval(), every named symbol (including imported
+           ones) is kept, since eval() can generate any of them by name. Returns the number of symbols removed.
+        """
+        if any(isinstance(sym, FuncSymbol) and sym.fname == "eval" for sym in self.symtab.values()):
+            to_check = {name for name in self.symtab if "[" not in name}
+        else:
+            to_check = {name for name in self.symtab if "." not in name and "[" not in name}
+        reachable = set()
+        while to_check:
+            name = to_check.pop()
+            reachable.add(name)
+            to_check |= self.symtab[name].children() - reachable
+        unreachable = set(self.symtab) - reachable
+        for name in unreachable:
+            del self.symtab[name]
+        self.tracked &= reachable
+        return len(unreachable)
+
+    def _check_funcs(self, funcs_used):
+        undefined = funcs_used - set(self.funcs)
+        if undefined:
+            raise IntegrityError("Function %s used but not defined" % sorted(undefined)[0])
+        if set(self.funcs) != funcs_used:
+            unused_kwds = tuple(set(self.funcs) - funcs_used)
+            raise IntegrityError("Unused keyword argument%s: %s" % ("s" if len(unused_kwds) > 1 else "", unused_kwds))
+
     def sanity_check(self):
         log.debug("sanity checking symtab: %s", self.symtab)
         log.debug("tracked symbols: %s", self.tracked)
@@ -368,9 +967,8 @@ class Grammar(object):
             sym.sanity_check(self)
             if isinstance(sym, FuncSymbol):
                 funcs_used.add(sym.fname)
-        if set(self.funcs) != funcs_used:
-            unused_kwds = tuple(set(self.funcs) - funcs_used)
-            raise IntegrityError("Unused keyword argument%s: %s" % ("s" if len(unused_kwds) > 1 else "", unused_kwds))
+        self._check_funcs(funcs_used)
+        self._funcs_used = funcs_used
         if "root" not in self.symtab:
             raise IntegrityError("Missing required start symbol: root")
         syms_used = {"root"}
@@ -380,7 +978,8 @@ class Grammar(object):
             sym = self.symtab[to_check.pop()]
             checked.add(sym.name)
             children = sym.children()
-            log.debug("%s is %s with %d children %s", sym.name, type(sym).__name__, len(children), list(children))
+            if self._trace:
+                log.debug("%s is %s with %d children %s", sym.name, type(sym).__name__, len(children), list(children))
             syms_used |= children
             to_check |= children - checked
         # ignore unused symbols that came from an import, Text, Regex, or Bin
@@ -451,46 +1050,229 @@ class Grammar(object):
                     issue[grandchild_name] = child_backtrace
 
     def is_limit_exceeded(self, gstate):
-        return (self._limit is not None and gstate.length >= self._limit) \
-                or any(sym["limited"] for sym in gstate.recursive_syms.values())
-
-    def generate(self, start="root"):
-        if not isinstance(start, _GenState):
-            gstate = _GenState(self)
-            gstate.symstack = [start]
-            gstate.instances = {sym: [] for sym in self.tracked}
-            gstate.instance_backlog = {sym: [] for sym in self.tracked}
+        return (self._limit is not None and gstate.length >= self._limit) or gstate.n_limited > 0
+
+    def compile(self):
+        # assign dense integer ids to every symbol, and build the plan used by generate()
+        self._names = sorted(self.symtab)
+        self._ids = {name: idx for (idx, name) in enumerate(self._names)}
+        self._syms = [self.symtab[name] for name in self._names]
+        self._ops = [sym.OPCODE for sym in self._syms]
+        self._args = [sym.compile(self) for sym in self._syms]
+        self._flags = []
+        for name in self._names:
+            flags = 0
+            if "[" not in name:
+                flags |= _FLAG_NAMED
+            if name in self.tracked:
+                flags |= _FLAG_TRACKED
+                if "[concat" in name:
+                    flags |= _FLAG_BACKREF
+            if name in self.recursive_syms:
+                flags |= _FLAG_RECURSIVE
+            self._flags.append(flags)
+        self._output_type = self._find_output_type()
+
+    def _find_output_type(self):
+        # str or bytes if that is the only type of value the grammar can generate, otherwise None
+        types = set()
+        for sym in self._syms:
+            if isinstance(sym, BinSymbol):
+                types.add(bytes)
+            elif isinstance(sym, (TextSymbol, RegexSymbol, _TextChoiceSymbol)):
+                types.add(str)
+            elif isinstance(sym, FuncSymbol) and sym.fname != "eval":
+                if self.funcs[sym.fname] is not None:
+                    return None # functions passed to the Grammar can return either
+                types.add(str)
+        if len(types) > 1:
+            return None
+        return bytes if bytes in types else str
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._local.rng = self.rng
+
+    def thread_rng(self):
+        """Return the RNG used for generation without a seed in the current thread.
+           This is `Grammar.rng` in the thread which created the Grammar. Other threads use their own RNG seeded from
+           it, so generation from a single Grammar in several threads at once shares no mutable state.
+        """
+        try:
+            return self._local.rng
+        except AttributeError:
+            self._local.rng = random.Random(self.rng.getrandbits(64))
+            return self._local.rng
+
+    def _start_id(self, start):
+        try:
+            return self._ids[start]
+        except KeyError:
+            raise GenerationError("start symbol %r is not defined" % start)
+
+    def generate(self, start="root", seed=None, profile=None):
+        """Generate an output starting from symbol `start`.
+           If `seed` is given, all randomness comes from an RNG seeded with it, so the output is fully determined by
+           `seed` and `Grammar.hash` (given the same functions are passed to the Grammar). Otherwise, the output comes
+           from the ongoing `Grammar.rng` sequence.
+           If `profile` is a GenerationProfile, the symbols generated are recorded in it.
+        """
+        if isinstance(start, _GenState):
+            return self._generate(start)
+        gstate = _GenState(self)
+        gstate.profile = profile
+        gstate.reset(self._start_id(start), seed)
+        return self._generate(gstate)
+
+    def profile(self, n=1, start="root", seed=None):
+        """Generate `n` outputs as iter_many() does, and return a GenerationProfile of the symbols generated.
+           The outputs are discarded. To profile a single output, pass a GenerationProfile to generate().
+        """
+        profile = GenerationProfile(self)
+        for _ in self.iter_many(n, start, seed, profile=profile):
+            pass
+        return profile
+
+    def generate_many(self, n, start="root", seed=None):
+        """Generate a list of `n` outputs. This is faster than calling generate() `n` times, see iter_many()."""
+        return list(self.iter_many(n, start, seed))
+
+    def iter_many(self, n=None, start="root", seed=None, profile=None):
+        """Generate `n` outputs (or forever if `n` is None), yielding each as soon as it is complete.
+           The generation state is allocated once, and reset between outputs. If `seed` is given, each output is
+           generated with a seed derived from it and the output index (see testcase_seed()).
+        """
+        gstate = _GenState(self)
+        gstate.profile = profile
+        start = self._start_id(start)
+        count = 0
+        while n is None or count < n:
+            gstate.reset(start, None if seed is None else Grammar.testcase_seed(seed, count))
+            yield self._generate(gstate)
+            count += 1
+
+    def generate_iter(self, start="root", chunk_size=DEFAULT_CHUNK_SIZE, seed=None, profile=None):
+        """Generate a single output, yielding it in chunks as it is generated.
+           Output is held back while it may still be needed by a reference, so chunks will usually be a little over
+           `chunk_size` in length, but can be much larger.
+        """
+        gstate = _GenState(self)
+        gstate.profile = profile
+        gstate.reset(self._start_id(start), seed)
+        for chunk in self._expand(gstate, chunk_size):
+            if profile is None:
+                yield chunk
+            else:
+                # time spent by the caller isn't part of any symbol
+                profile.pause()
+                yield chunk
+                profile.resume()
+        if gstate.output:
+            yield gstate.flush()
+
+    def generate_to(self, fileobj, start="root", chunk_size=DEFAULT_CHUNK_SIZE, seed=None, profile=None):
+        """Generate a single output, writing it to `fileobj` in chunks as it is generated (see generate_iter())."""
+        for chunk in self.generate_iter(start, chunk_size, seed, profile):
+            fileobj.write(chunk)
+
+    @staticmethod
+    def testcase_seed(seed, index):
+        """Derive the seed for output number `index` of generate_parallel() or iter_many() from the base `seed`.
+           `seed` can be any value accepted by generate(). Other than integers, it is identified by its repr().
+           A single output can be reproduced with ``grammar.generate(seed=Grammar.testcase_seed(seed, index))``.
+        """
+        key = "%d" % seed if isinstance(seed, numbers.Integral) else repr(seed)
+        return int(hashlib.sha512(("%s:%d" % (key, index)).encode("utf-8")).hexdigest()[:16], 16)
+
+    def generate_parallel(self, n, workers=None, seed=None, ordered=True, start="root", chunksize=16):
+        """Generate `n` outputs using a pool of `workers` processes (default is one per CPU).
+
+           Returns an iterator of (index, output) tuples, in index order if `ordered` is True, or as soon as each output is complete
+           otherwise. Each output is generated with a seed derived from `seed` and its index (see testcase_seed()), so
+           the results do not depend on the number of workers. On platforms that support fork(), the grammar is
+           inherited by the workers, otherwise it must be picklable (including any functions it was created with).
+        """
+        self._start_id(start) # raise here, not when the results are first iterated
+        if seed is None:
+            seed = self.thread_rng().getrandbits(64)
+            log.debug("generate_parallel() using random seed %d", seed)
+        return self._generate_parallel(n, workers, seed, ordered, start, chunksize)
+
+    def _generate_parallel(self, n, workers, seed, ordered, start, chunksize):
+        if not hasattr(multiprocessing, "get_context"):
+            context = multiprocessing # python 2 always forks where available
+        elif "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
         else:
-            gstate = start
+            context = multiprocessing.get_context()
+        pool = context.Pool(workers, _parallel_init, (self,))
+        try:
+            tasks = ((idx, start, Grammar.testcase_seed(seed, idx)) for idx in range(n))
+            imap = pool.imap if ordered else pool.imap_unordered
+            for result in imap(_parallel_generate, tasks, chunksize):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _generate(self, gstate):
+        for _ in self._expand(gstate, None):
+            pass # no chunks are flushed without a chunk size
+        return gstate.flush()
+
+    @staticmethod
+    def _flush_chunk(gstate, pending):
+        for instance in pending:
+            instance.get(gstate)
+        del pending[:]
+        return gstate.flush()
+
+    def _expand(self, gstate, chunk_size):
+        # Generate until the symstack is empty. If chunk_size is given, output is yielded when at least chunk_size has
+        # been generated and no tracked symbol is still open, otherwise it is all left in gstate.output.
+        # The symstack holds ids of symbols to be generated, bitwise inverted ids (< 0) of symbols to be unwound, and
+        # tuples for other commands.
+        symstack, syms, ops, args, flags = gstate.symstack, self._syms, self._ops, self._args, self._flags
+        profile = gstate.profile
         tracking = []
-        while gstate.symstack:
-            this = gstate.symstack.pop()
+        pending = [] # instances which point into the output, and need their value before it is flushed
+        flush_at = gstate.length + chunk_size if chunk_size else float("inf")
+        while symstack:
+            this = symstack.pop()
             backlog = False
             if isinstance(this, tuple):
                 cmd = this[0]
-                if cmd == 'unwind':
-                    if this[1] in gstate.recursive_syms:
-                        recursion_state = gstate.recursive_syms[this[1]]
-                        recursion_state["depth"] -= 1
-                        if recursion_state["depth"] <= 0:
-                            del gstate.recursive_syms[this[1]]
-                    continue
-                elif cmd == 'resetbackref':
-                    gstate.backrefs.pop()
-                    continue
-                elif cmd == 'backlog':
+                if cmd == 'backlog':
                     this = this[1]
                     backlog = True
                 elif cmd == "untrack":
                     tracked = tracking.pop()
-                    assert this[1] == tracked[0], "Tracking mismatch: expected '%s', got '%s'" % (tracked[0], this[1])
-                    instance = "".join(gstate.output[tracked[1]:])
-                    if "[concat" in this[1]:
+                    assert this[1] == tracked[0], "Tracking mismatch: expected '%s', got '%s'" \
+                        % (self._names[tracked[0]], self._names[this[1]])
+                    instance = _Instance(gstate.output, tracked[1], len(gstate.output))
+                    if chunk_size:
+                        pending.append(instance)
+                    if flags[this[1]] & _FLAG_BACKREF:
                         gstate.backrefs[-1][this[1]] = instance
                     elif this[2]:
                         gstate.instance_backlog[this[1]].append(instance)
                     else:
-                        gstate.instances[this[1]].append(instance)
+                        gstate.add_instance(this[1], instance)
+                    continue
+                elif cmd == "repeat":
+                    # next iteration of a RepeatSymbol, stop early if the limit was hit after generating min_
+                    sym, done, reps = this[1:]
+                    if done >= syms[sym].min_ and self.is_limit_exceeded(gstate):
+                        continue
+                    if done + 1 < reps:
+                        symstack.append(("repeat", sym, done + 1, reps))
+                    symstack.extend(args[sym])
                     continue
                 elif cmd == "choice":
                     sym, choice = this[1:]
@@ -501,44 +1283,80 @@ class Grammar(object):
                     continue
                 else:
                     raise GenerationError("Unknown tuple command: %s" % cmd)
-            if this in self.recursive_syms:
-                if this in gstate.recursive_syms:
-                    recursive_state = gstate.recursive_syms[this]
-                    recursive_state["depth"] += 1
-                    if recursive_state["depth"] >= recursive_state["depth_limit"]:
-                        recursive_state["limited"] = True
-                else:
-                    gstate.recursive_syms[this] = {"depth": 1,
-                                                   "depth_limit": random.randint(2, random.randint(2, 25)),
-                                                   "limited": False}
-            if this in self.tracked: # need to capture everything generated by this symbol and add to "instances"
-                if not backlog and gstate.instance_backlog[this]:
-                    # there is an instance previously generated in the backlog, use it instead
-                    idx = random.randrange(len(gstate.instance_backlog[this]))
-                    value = gstate.instance_backlog[this].pop(idx)
-                    gstate.instances[this].append(value)
-                    gstate.append(value)
-                    continue
-                gstate.symstack.append(("untrack", this, backlog))
-                tracking.append((this, len(gstate.output)))
-            gstate.symstack.append(('unwind', this))
-            if "[" not in this:
-                gstate.symstack.append(("resetbackref",))
-                gstate.backrefs.append({})
-            try:
-                self.symtab[this].generate(gstate)
-            except GenerationError:
-                raise
-            except Exception as err:
-                raise GenerationError("%s: %s" % (type(err).__name__, str(err)))
-        try:
-            return "".join(gstate.output)
-        except TypeError:
-            return b"".join(gstate.output)
+            elif this < 0:
+                # unwind
+                this = ~this
+                if profile is not None:
+                    profile.exit(gstate.length)
+                if flags[this] & _FLAG_RECURSIVE and this in gstate.recursive_syms:
+                    recursion_state = gstate.recursive_syms[this]
+                    recursion_state["depth"] -= 1
+                    if recursion_state["depth"] <= 0:
+                        if recursion_state["limited"]:
+                            gstate.n_limited -= 1
+                        del gstate.recursive_syms[this]
+                if flags[this] & _FLAG_NAMED:
+                    gstate.backrefs.pop()
+                if gstate.length >= flush_at and not tracking:
+                    yield self._flush_chunk(gstate, pending)
+                    flush_at = gstate.length + chunk_size
+                continue
+            op, flag = ops[this], flags[this]
+            if profile is not None:
+                profile.enter(this, gstate.length)
+            if flag:
+                if flag & _FLAG_RECURSIVE:
+                    if this in gstate.recursive_syms:
+                        recursive_state = gstate.recursive_syms[this]
+                        recursive_state["depth"] += 1
+                        if recursive_state["depth"] >= recursive_state["depth_limit"] and not recursive_state["limited"]:
+                            recursive_state["limited"] = True
+                            gstate.n_limited += 1
+                    else:
+                        gstate.recursive_syms[this] = {"depth": 1,
+                                                       "depth_limit": gstate.rng.randint(2, gstate.rng.randint(2, 25)),
+                                                       "limited": False}
+                if flag & _FLAG_TRACKED: # need to capture everything generated by this symbol and add to "instances"
+                    if not backlog and gstate.instance_backlog[this]:
+                        # there is an instance previously generated in the backlog, use it instead
+                        backlog = gstate.instance_backlog[this]
+                        idx = gstate.rng.randrange(len(backlog))
+                        backlog[idx], backlog[-1] = backlog[-1], backlog[idx] # order doesn't matter, so pop from the end
+                        instance = backlog.pop()
+                        gstate.add_instance(this, instance)
+                        gstate.append(instance.get(gstate))
+                        if profile is not None:
+                            profile.exit(gstate.length)
+                        continue
+                    symstack.append(("untrack", this, backlog))
+                    tracking.append((this, len(gstate.output)))
+                if flag & _FLAG_NAMED:
+                    gstate.backrefs.append({})
+                symstack.append(~this)
+            elif op != _OP_TEXT:
+                symstack.append(~this) # text symbols can't fail or push anything, so no need to unwind
+            if op == _OP_TEXT:
+                gstate.append(args[this])
+                if profile is not None and not flag:
+                    profile.exit(gstate.length)
+                if gstate.length >= flush_at and not tracking:
+                    yield self._flush_chunk(gstate, pending)
+                    flush_at = gstate.length + chunk_size
+            elif op == _OP_CONCAT:
+                symstack.extend(args[this])
+            else:
+                try:
+                    syms[this].generate(gstate)
+                except GenerationError:
+                    raise
+                except Exception as err:
+                    raise GenerationError("%s: %s" % (type(err).__name__, str(err)))
 
 
 class _Symbol(object):
-    _RE_DEFN = re.compile(r"""^((?P<quote>["'])
+    OPCODE = _OP_CALL
+    # no enclosing group, so match.lastgroup is the name of the alternative matched
+    _RE_DEFN = re.compile(r"""(?P<quote>["'])
                                 |(?P<hexstr>x["'])
                                 |(?P<regex>/)
                                 |(?P<implconcat>\()
@@ -550,7 +1368,7 @@ class _Symbol(object):
                                 |(?P<repeat>[{<]\s*(?P<a>\d+|\*)\s*(,\s*(?P<b>\d+|\*)\s*)?[}>])
                                 |@(?P<refprefix>[\w-]+\.)?(?P<ref>[\w:-]+)
                                 |(?P<symprefix>[\w-]+\.)?(?P<sym>[\w:-]+)
-                                |(?P<ws>\s+))""", re.VERBOSE)
+                                |(?P<ws>\s+)""", re.VERBOSE)
 
     def __init__(self, name, pstate, no_add=False):
         if name == '%s.import' % pstate.prefix:
@@ -561,15 +1379,25 @@ class _Symbol(object):
                              % (unprefixed, pstate.imports[unprefixed][1]))
         self.name = name
         self.line_no = pstate.line_no
-        log.debug('\t%s %s', type(self).__name__.lower()[:-6], name)
+        if pstate.trace:
+            log.debug('\t%s %s', type(self).__name__.lower()[:-6], name)
         if not no_add:
             if name in pstate.grmr.symtab and not isinstance(pstate.grmr.symtab[name], (_AbstractSymbol, RefSymbol)):
                 unprefixed = name.split(".", 1)[1]
                 raise ParseError("Redefinition of symbol %s previously declared on line %d"
                                  % (unprefixed, pstate.grmr.symtab[name].line_no))
             pstate.grmr.symtab[name] = self
+            pstate.symbols[name] = self
         self.can_terminate = None
 
+    def copy(self):
+        """Return a copy of this symbol which can be modified by normalize() and compile() without affecting this one.
+           Parsed values are shared.
+        """
+        result = type(self).__new__(type(self))
+        result.__dict__.update(self.__dict__)
+        return result
+
     def map(self, fcn):
         pass
 
@@ -579,6 +1407,10 @@ class _Symbol(object):
     def sanity_check(self, grmr):
         pass
 
+    def compile(self, grmr):
+        # resolve symbol names needed at generation time to ids, and return the argument for OPCODE in the plan
+        return None
+
     def generate(self, gstate):
         raise GenerationError("Can't generate symbol %s of type %s" % (self.name, type(self)))
 
@@ -587,32 +1419,37 @@ class _Symbol(object):
 
     def update_can_terminate(self, grmr):
         if all(grmr.symtab[c].can_terminate for c in self.children()):
-            log.debug("%s can terminate", self.name)
+            if grmr._trace: # pylint: disable=protected-access
+                log.debug("%s can terminate", self.name)
             self.can_terminate = True
             return True
         return False
 
     @staticmethod
-    def _parse(defn, pstate, in_func, in_concat):
+    def _parse(defn, pos, pstate, in_func, in_concat):
+        # parse symbols from defn starting at pos, returns (symbol names, position of the first unparsed character)
         result = []
-        while defn:
-            match = _Symbol._RE_DEFN.match(defn)
+        end = len(defn)
+        while pos < end:
+            match = _Symbol._RE_DEFN.match(defn, pos)
             if match is None:
-                raise ParseError("Failed to parse definition at: %s" % defn)
-            log.debug("parsed %s from %s", {k: v for k, v in match.groupdict().items() if v is not None}, defn)
-            if match.group("ws") is not None:
-                defn = defn[match.end(0):]
+                raise ParseError("Failed to parse definition at: %s" % defn[pos:])
+            if pstate.trace:
+                log.debug("parsed %s from %s", {k: v for k, v in match.groupdict().items() if v is not None},
+                          defn[pos:])
+            kind = match.lastgroup
+            if kind == "ws":
+                pos = match.end(0)
                 continue
-            if match.group("quote"):
-                sym, defn = TextSymbol.parse(defn, pstate)
-            elif match.group("hexstr"):
-                sym, defn = BinSymbol.parse(defn, pstate)
-            elif match.group("regex"):
-                sym, defn = RegexSymbol.parse(defn, pstate)
-            elif match.group("func"):
-                defn = defn[match.end(0):]
-                sym, defn = FuncSymbol.parse(match.group("func"), defn, pstate)
-            elif match.group("ref"):
+            if kind == "quote":
+                sym, pos = TextSymbol.parse(defn, pos, pstate)
+            elif kind == "hexstr":
+                sym, pos = BinSymbol.parse(defn, pos, pstate)
+            elif kind == "regex":
+                sym, pos = RegexSymbol.parse(defn, pos, pstate)
+            elif kind == "func":
+                sym, pos = FuncSymbol.parse(match.group("func"), defn, match.end(0), pstate)
+            elif kind == "ref":
                 ref = pstate.get_prefixed(match.group("refprefix"), match.group("ref"))
                 try:
                     backref = int(match.group("ref"))
@@ -620,61 +1457,61 @@ class _Symbol(object):
                     pass
                 else:
                     if match.group("refprefix"):
-                        raise ParseError("Invalid reference syntax at: %s" % defn)
+                        raise ParseError("Invalid reference syntax at: %s" % defn[pos:])
                     if not (1 <= backref <= len(pstate.capture_groups)) or pstate.capture_groups[backref - 1] is None:
-                        raise IntegrityError("Invalid backreference at: %s" % defn)
+                        raise IntegrityError("Invalid backreference at: %s" % defn[pos:])
                     ref = pstate.capture_groups[backref-1]
                 sym = RefSymbol(ref, pstate)
-                defn = defn[match.end(0):]
-            elif match.group("sym"):
+                pos = match.end(0)
+            elif kind == "sym":
                 sym_name = pstate.get_prefixed(match.group("symprefix"), match.group("sym"))
                 try:
                     sym = pstate.grmr.symtab[sym_name]
                 except KeyError:
                     sym = _AbstractSymbol(sym_name, pstate)
-                defn = defn[match.end(0):]
-            elif match.group("comment"):
-                defn = ""
+                pos = match.end(0)
+            elif kind == "comment":
+                pos = end
                 break
-            elif match.group("infunc"):
+            elif kind == "infunc":
                 if in_func or (in_concat and match.group("infunc") == ")"):
                     break
-                raise ParseError("Unexpected token in definition: %s" % defn)
-            elif match.group("implconcat"):
+                raise ParseError("Unexpected token in definition: %s" % defn[pos:])
+            elif kind == "implconcat":
                 capture = len(pstate.capture_groups)
                 pstate.capture_groups.append(None)
-                parts, defn = _Symbol._parse(defn[match.end(0):], pstate, False, True)
-                if defn[0] not in ")|":
-                    raise ParseError("Expecting ) at: %s" % defn)
-                if defn[0] == "|":
+                parts, pos = _Symbol._parse(defn, match.end(0), pstate, False, True)
+                if defn[pos] not in ")|":
+                    raise ParseError("Expecting ) at: %s" % defn[pos:])
+                if defn[pos] == "|":
                     # implicit choice:
                     name = "[choice (line %d #%d)]" % (pstate.line_no, pstate.implicit())
                     sym = ChoiceSymbol(name, pstate)
                     sym.append(parts, 1, pstate)
-                    while defn[0] == "|":
-                        parts, defn = _Symbol._parse(defn[1:], pstate, False, True)
-                        if not defn[0] in ")|":
-                            raise ParseError("Expecting ) or | at: %s" % defn)
+                    while defn[pos] == "|":
+                        parts, pos = _Symbol._parse(defn, pos + 1, pstate, False, True)
+                        if not defn[pos] in ")|":
+                            raise ParseError("Expecting ) or | at: %s" % defn[pos:])
                         sym.append(parts, 1, pstate)
                 else:
                     name = "[concat (line %d #%d)]" % (pstate.line_no, pstate.implicit())
                     sym = ConcatSymbol(name, pstate)
                     sym.extend(parts)
                 pstate.capture_groups[capture] = sym.name
-                defn = defn[1:]
-            elif match.group("implchoice"):
+                pos += 1
+            elif kind == "implchoice":
                 if in_concat:
                     break
-                raise ParseError("Unexpected token in definition: %s" % defn)
-            elif match.group("maybe") or match.group("repeat"):
+                raise ParseError("Unexpected token in definition: %s" % defn[pos:])
+            elif kind in ("maybe", "repeat"):
                 if not result:
-                    raise ParseError("Unexpected token in definition: %s" % defn)
-                if match.group("maybe"):
+                    raise ParseError("Unexpected token in definition: %s" % defn[pos:])
+                if kind == "maybe":
                     repeat = RepeatSymbol
                     min_, max_ = 0, 1
                 else:
                     if {"{": "}", "<": ">"}[match.group(0)[0]] != match.group(0)[-1]:
-                        raise ParseError("Repeat symbol mismatch at: %s" % defn)
+                        raise ParseError("Repeat symbol mismatch at: %s" % defn[pos:])
                     repeat = {"{": RepeatSymbol, "<": RepeatSampleSymbol}[match.group(0)[0]]
                     min_ = "*" if match.group("a") == "*" else int(match.group("a"))
                     max_ = ("*" if match.group("b") == "*" else int(match.group("b"))) if match.group("b") else min_
@@ -682,19 +1519,19 @@ class _Symbol(object):
                 name = "[repeat (line %d #%d)]" % (pstate.line_no, pstate.implicit())
                 sym = repeat(name, min_, max_, pstate)
                 sym.append(parts)
-                defn = defn[match.end(0):]
+                pos = match.end(0)
             result.append(sym.name)
-        return result, defn
+        return result, pos
 
     @staticmethod
-    def parse_func_arg(defn, pstate):
-        return _Symbol._parse(defn, pstate, True, False)
+    def parse_func_arg(defn, pos, pstate):
+        return _Symbol._parse(defn, pos, pstate, True, False)
 
     @staticmethod
     def parse(defn, pstate):
-        res, remain = _Symbol._parse(defn, pstate, False, False)
-        if remain:
-            raise ParseError("Unexpected token in definition: %s" % remain)
+        res, pos = _Symbol._parse(defn, 0, pstate, False, False)
+        if pos < len(defn):
+            raise ParseError("Unexpected token in definition: %s" % defn[pos:])
         return res
 
 
@@ -718,6 +1555,7 @@ class BinSymbol(_Symbol):
        the output.
     """
 
+    OPCODE = _OP_TEXT
     _RE_QUOTE = re.compile(r"""(?P<end>["'])""")
 
     def __init__(self, value, pstate):
@@ -729,22 +1567,24 @@ class BinSymbol(_Symbol):
             raise ParseError("Invalid hex string: %s" % err)
         self.can_terminate = True
 
+    def compile(self, grmr):
+        return self.value
+
     def generate(self, gstate):
         gstate.append(self.value)
 
     @staticmethod
-    def parse(defn, pstate):
-        start, qchar, defn = defn[0], defn[1], defn[2:]
+    def parse(defn, pos, pstate):
+        start, qchar = defn[pos], defn[pos + 1]
         if start != "x":
-            raise ParseError("Error parsing binary string at: %s%s%s" % (start, qchar, defn))
+            raise ParseError("Error parsing binary string at: %s" % defn[pos:])
         if qchar not in "'\"":
-            raise ParseError("Error parsing binary string at: %s%s" % (qchar, defn))
-        enquo = defn.find(qchar)
+            raise ParseError("Error parsing binary string at: %s" % defn[pos + 1:])
+        enquo = defn.find(qchar, pos + 2)
         if enquo == -1:
             raise ParseError("Unterminated bin literal!")
-        value, defn = defn[:enquo], defn[enquo+1:]
-        sym = BinSymbol(value, pstate)
-        return sym, defn
+        sym = BinSymbol(defn[pos + 2:enquo], pstate)
+        return sym, enquo + 1
 
 
 class ChoiceSymbol(_Symbol):
@@ -774,6 +1614,19 @@ class ChoiceSymbol(_Symbol):
         self._choices_terminate = []
         self.normalized = False
         self.length = None
+        self._id = None
+        self._value_ids = []
+        self._table = None # (cumulative weights, value ids) for choice()
+        self._table_terminate = None # same, using only the choices which can terminate
+        self._sampler = None # FenwickSampler over all choices, with '+' choices flattened
+        self._sample_cmds = [] # symstack commands to cache each flattened choice in self._sampler
+
+    def copy(self):
+        result = _Symbol.copy(self)
+        result.weights = list(self.weights)
+        result.was_plus = list(self.was_plus)
+        result._choices_terminate = list(self._choices_terminate) # pylint: disable=protected-access
+        return result
 
     def append(self, value, weight, pstate):
         if weight != '+':
@@ -788,66 +1641,41 @@ class ChoiceSymbol(_Symbol):
         self.was_plus.append(None)
         self._choices_terminate.append(None)
 
-    def _cache_choice(self, choice, gstate):
-        gstate.choice_stack.setdefault(self.name, []).append(choice)
-
-    def _internal_choice(self, total, used, plus_state, result, gstate):
-        target = random.uniform(0, total[0])
-        log.debug("%s: looking for target %.2f from total %.2f", self.name, target, total[0])
-        log.debug("-> blacklist: %r", used)
-        for i, (weight, value, was_plus) in enumerate(zip(self.weights, self.values, self.was_plus)):
-            if was_plus and plus_state is not None:
-                choice = gstate.grmr.symtab[gstate.grmr.symtab[value].choice]
-                if isinstance(used[i], bool):
-                    plus_state[i] = {"total": [choice.total], "substate": {}}
-                    used[i] = [False] * len(choice.values)
-                target -= plus_state[i]["total"][0]
-                if target < 0.0:
-                    log.debug("choice is in + at %d", i)
-                    total[0] -= plus_state[i]["total"][0]
-                    choice._internal_choice(plus_state[i]["total"], used[i], plus_state[i]["substate"], result, gstate)
-                    total[0] += plus_state[i]["total"][0]
-                    result.append((self.name, value))
-                    return
-                log.debug('-> %d had weight of %.2f, not the target', i, plus_state[i]["total"][0])
-            elif not used[i]:
-                target -= weight
-                if target < 0.0:
-                    log.debug("choice is at %d", i)
-                    used[i] = True
-                    total[0] -= weight
-                    result.append((self.name, value))
-                    return
-                log.debug('-> %d had weight of %.2f, not the target', i, weight)
-        raise GenerationError("Too much total weight in %s? remainder is %.2f from %.2f total"
-                              % (self.name, target, total[0]))
-
-    def choice(self, whitelist, gstate):
-        if gstate.choice_stack.get(self.name):
-            return gstate.choice_stack[self.name].pop()
-        if whitelist is not None:
-            assert len(whitelist) == len(self.values)
-            blacklist = [not x for x in whitelist]
-            total = self.total - sum(weight for (weight, used) in zip(self.weights, blacklist) if used)
-        else:
-            blacklist = [False] * len(self.values)
-            total = self.total
-        result = []
-        self._internal_choice([total], blacklist, None, result, gstate)
-        assert len(result) == 1
-        assert result[0][0] == self.name
-        return result[0][1]
+    def _cumulative_table(self, whitelist):
+        cumulative, ids, total = [], [], 0.0
+        for i, (weight, value) in enumerate(zip(self.weights, self._value_ids)):
+            if weight and (whitelist is None or whitelist[i]):
+                total += weight
+                cumulative.append(total)
+                ids.append(value)
+        return cumulative, ids
+
+    def choice(self, terminate, gstate):
+        # choose a value id, from only the choices which can terminate if `terminate` is True
+        if gstate.choice_stack.get(self._id):
+            return gstate.choice_stack[self._id].pop()
+        # binary search in a precomputed table of cumulative weights
+        cumulative, ids = self._table_terminate if terminate else self._table
+        if not ids:
+            raise GenerationError("No choices with weight in %s" % self.name)
+        idx = bisect.bisect_right(cumulative, gstate.rng.uniform(0, cumulative[-1]))
+        return ids[min(idx, len(ids) - 1)]
+
+    def _flatten(self, grmr):
+        # yield (weight, chain) for each choice, where '+' choices are replaced by the choices they include, and chain
+        # is the list of (choice id, value id) needed to generate it, innermost first
+        sym_id = grmr._ids[self.name] # pylint: disable=protected-access
+        for (weight, value, was_plus) in zip(self.weights, self.values, self.was_plus):
+            link = (sym_id, grmr._ids[value]) # pylint: disable=protected-access
+            if was_plus:
+                for (sub_weight, chain) in grmr.symtab[grmr.symtab[value].choice]._flatten(grmr):
+                    yield sub_weight, chain + (link,)
+            else:
+                yield weight, (link,)
 
     def sample(self, k, gstate):
         # should return cache results for future generate()s
-        used, total, plus_state, result = ([False] * len(self.values)), [self.total], {}, []
-        while len(result) < k:
-            this_result = []
-            if total[0] <= 0.0:
-                break
-            self._internal_choice(total, used, plus_state, this_result, gstate)
-            result.append(tuple(("choice", choice[0], choice[1]) for choice in this_result))
-        return result
+        return [self._sample_cmds[idx] for idx in self._sampler.sample(k, gstate.rng)]
 
     def normalize(self, grmr):
         if self.normalized:
@@ -873,11 +1701,20 @@ class ChoiceSymbol(_Symbol):
         if self.total <= 0.0:
             raise IntegrityError("Invalid total weight for symbol %s: %r" % (self.name, self.total))
 
+    def compile(self, grmr):
+        self._id = grmr._ids[self.name] # pylint: disable=protected-access
+        self._value_ids = [grmr._ids[value] for value in self.values] # pylint: disable=protected-access
+        self._table = self._cumulative_table(None)
+        self._table_terminate = self._cumulative_table(self._choices_terminate)
+        flattened = list(self._flatten(grmr))
+        self._sampler = FenwickSampler(weight for (weight, _) in flattened)
+        self._sample_cmds = [tuple(("choice", sym, value) for (sym, value) in chain) for (_, chain) in flattened]
+
     def generate(self, gstate):
         if gstate.grmr.is_limit_exceeded(gstate) and self.can_terminate:
-            gstate.symstack.append(self.choice(self._choices_terminate, gstate))
+            gstate.symstack.append(self.choice(True, gstate))
         else:
-            gstate.symstack.append(self.choice(None, gstate))
+            gstate.symstack.append(self.choice(False, gstate))
 
     def children(self):
         return set(self.values)
@@ -890,7 +1727,8 @@ class ChoiceSymbol(_Symbol):
             if grmr.symtab[choice].can_terminate:
                 self._choices_terminate[i] = True
         if any(self._choices_terminate):
-            log.debug("%s can terminate", self.name)
+            if grmr._trace: # pylint: disable=protected-access
+                log.debug("%s can terminate", self.name)
             self.can_terminate = True
             return True
         return False
@@ -918,21 +1756,33 @@ class ConcatSymbol(_Symbol, list):
        This is most useful for defining implicit repeats for some terms in the concatenation.
     """
 
+    OPCODE = _OP_CONCAT
+
     def __init__(self, name, pstate, no_prefix=False):
         name = "%s.%s" % (pstate.prefix, name) if not no_prefix else name
         _Symbol.__init__(self, name, pstate)
         list.__init__(self)
         self.choice = None # if this concat is choosable, this will be the sym.name of the subchoice
         self.normalized = None
+        self._ids = ()
 
     def children(self):
         return set(self)
 
+    def copy(self):
+        result = _Symbol.copy(self)
+        result.extend(self)
+        return result
+
     def map(self, fcn):
         list.__init__(self, [fcn(i) for i in self])
 
+    def compile(self, grmr):
+        self._ids = tuple(grmr._ids[child] for child in reversed(self)) # pylint: disable=protected-access
+        return self._ids
+
     def generate(self, gstate):
-        gstate.symstack.extend(reversed(self))
+        gstate.symstack.extend(self._ids)
 
     def normalize(self, grmr):
         if self.normalized:
@@ -991,9 +1841,10 @@ class FuncSymbol(_Symbol):
         _Symbol.__init__(self, sname, pstate)
         self.fname = name
         self.args = []
+        self._arg_ids = []
         self.imports = None
         if name == "eval":
-            self.imports = pstate # retain pstate for resolving imports later
+            self.imports = (pstate.prefix, pstate.imports) # retained for resolving imports later
 
     def sanity_check(self, grmr):
         if self.fname not in grmr.funcs:
@@ -1001,15 +1852,20 @@ class FuncSymbol(_Symbol):
 
     def generate(self, gstate):
         args = []
-        for arg in self.args:
-            if isinstance(arg, numbers.Number):
+        for (arg_id, arg) in self._arg_ids:
+            if arg_id is None:
                 args.append(arg)
+                if not isinstance(arg, numbers.Number):
+                    gstate.length += len(arg) # counted as if it were generated, like symbol args
             else:
                 symstack, output = gstate.symstack, gstate.output
-                gstate.symstack, gstate.output = [arg], []
-                args.append(gstate.grmr.generate(gstate))
+                gstate.symstack, gstate.output = [arg_id], gstate.new_output()
+                args.append(gstate.grmr._generate(gstate)) # pylint: disable=protected-access
                 gstate.symstack, gstate.output = symstack, output
-        if self.fname == "eval" and gstate.grmr.funcs["eval"] is None:
+        func = gstate.grmr.funcs[self.fname]
+        if func is not None:
+            gstate.append(func(*args))
+        elif self.fname == "eval":
             # TODO: this should support imports in the original grammar
             if len(args) != 1:
                 raise TypeError("eval() takes exactly 1 arguments (%d given)" % len(args))
@@ -1019,35 +1875,47 @@ class FuncSymbol(_Symbol):
                 prefix, name = "", args[0]
             prefix = self.imports[prefix]
             if prefix:
-                gstate.symstack.append("%s.%s" % (prefix, name))
-            else:
-                gstate.symstack.append(name)
-        elif self.fname == "id" and gstate.grmr.funcs["id"] is None:
+                name = "%s.%s" % (prefix, name)
+            gstate.symstack.append(gstate.grmr._ids[name]) # pylint: disable=protected-access
+        elif self.fname == "id":
             if len(args) != 0:
                 raise TypeError("id() takes 0 arguments (%d given)" % len(args))
             gstate.generate_id()
         else:
-            gstate.append(gstate.grmr.funcs[self.fname](*args))
+            gstate.append(_RNG_FUNCS[self.fname](gstate.rng, *args))
 
     def children(self):
         return set(a for a in self.args if not isinstance(a, numbers.Number))
 
+    def compile(self, grmr):
+        # (id, None) for symbol args, or (None, value) for numeric args and args folded to text by optimize()
+        # folded args still count towards the output length in generate(), so limits are checked the same
+        # pylint: disable=protected-access
+        self._arg_ids = []
+        for arg in self.args:
+            if isinstance(arg, numbers.Number):
+                self._arg_ids.append((None, arg))
+            elif isinstance(grmr.symtab[arg], (TextSymbol, BinSymbol)):
+                self._arg_ids.append((None, grmr.symtab[arg].value))
+            else:
+                self._arg_ids.append((grmr._ids[arg], None))
+
     def map(self, fcn):
         _fcn = lambda x: x if isinstance(x, numbers.Number) else fcn(x)
         self.args = [_fcn(i) for i in self.args]
 
     @staticmethod
-    def parse(name, defn, pstate):
+    def parse(name, defn, pos, pstate):
         if name == "import":
             raise ParseError("'import' is a reserved function name")
         result = FuncSymbol(name, pstate)
         done = False
         while not done:
-            arg, defn = _Symbol.parse_func_arg(defn, pstate)
-            if defn[0] not in ",)":
-                raise ParseError("Expected , or ) parsing function args at: %s" % defn)
-            done = defn[0] == ")"
-            defn = defn[1:]
+            arg, pos = _Symbol.parse_func_arg(defn, pos, pstate)
+            if defn[pos] not in ",)":
+                raise ParseError("Expected , or ) parsing function args at: %s" % defn[pos:])
+            done = defn[pos] == ")"
+            pos += 1
             if arg or not done:
                 numeric_arg = False
                 if len(arg) == 1 and isinstance(pstate.grmr.symtab[arg[0]], _AbstractSymbol):
@@ -1065,7 +1933,7 @@ class FuncSymbol(_Symbol):
                     sym = ConcatSymbol("%s.%s]" % (result.name[:-1], len(result.args)), pstate, no_prefix=True)
                     sym.extend(arg)
                     result.args.append(sym.name)
-        return result, defn
+        return result, pos
 
 
 class RefSymbol(_Symbol):
@@ -1084,23 +1952,31 @@ class RefSymbol(_Symbol):
         if ref not in pstate.grmr.symtab:
             pstate.grmr.symtab[ref] = _AbstractSymbol(ref, pstate)
         self.ref = ref
+        self._ref_id = None
         pstate.grmr.tracked.add(ref)
 
+    def compile(self, grmr):
+        self._ref_id = grmr._ids[self.ref] # pylint: disable=protected-access
+
     def generate(self, gstate):
+        ref = self._ref_id
         if "[concat" in self.ref:
             backrefs = gstate.backrefs[-1]
             try:
-                gstate.append(backrefs[self.ref])
+                instance = backrefs[ref]
             except KeyError:
                 raise GenerationError("No symbols generated yet for backreference")
-        elif gstate.instances[self.ref]:
-            gstate.append(random.choice(gstate.instances[self.ref]))
-        elif len(gstate.instance_backlog[self.ref]) > 1 and random.random() < 0.3:
-            log.debug("No instances of %s yet, using one from the backlog instead", self.ref)
-            gstate.append(random.choice(gstate.instance_backlog[self.ref]))
+            gstate.append(instance.get(gstate))
+        elif gstate.instances[ref]:
+            gstate.append(gstate.rng.choice(gstate.instances[ref]).get(gstate))
+        elif len(gstate.instance_backlog[ref]) > 1 and gstate.rng.random() < 0.3:
+            if gstate.trace:
+                log.debug("No instances of %s yet, using one from the backlog instead", self.ref)
+            gstate.append(gstate.rng.choice(gstate.instance_backlog[ref]).get(gstate))
         else:
-            log.debug("No instances of %s yet, generating one instead of a reference", self.ref)
-            gstate.symstack.append(("backlog", self.ref))
+            if gstate.trace:
+                log.debug("No instances of %s yet, generating one instead of a reference", self.ref)
+            gstate.symstack.append(("backlog", ref))
 
     def children(self):
         return {self.ref}
@@ -1135,17 +2011,85 @@ class RegexSymbol(ConcatSymbol):
        syntax is *not* supported in RegexSymbol. The characters "()|" have no special meaning and do not need to be
        escaped.
     """
-    _RE_PARSE = re.compile(r"""^((?P<repeat>\{\s*(?P<a>\d+)\s*(,\s*(?P<b>\d+)\s*)?\}|\?)
+    _RE_PARSE = re.compile(r"""((?P<repeat>\{\s*(?P<a>\d+)\s*(,\s*(?P<b>\d+)\s*)?\}|\?)
                                  |(?P<set>\[\^?)
                                  |(?P<esc>\\.)
                                  |(?P<dot>\.)
                                  |(?P<done>/))""", re.VERBOSE)
-    _RE_SET = re.compile(r"^(\]|-|[\ud800-\udbff][\udc00-\udfff]|\\?.)")
+    _RE_SET = re.compile(r"(\]|-|[\ud800-\udbff][\udc00-\udfff]|\\?.)")
+
+    OPCODE = _OP_CALL
+    ALPHABET_MAX = 4096 # character sets up to this size are expanded to a list of characters by compile()
+    BATCH_MIN = 16 # latin-1 character sets repeated at least this many times are drawn in bulk by _rndtext()
 
     def __init__(self, pstate):
         name = "%s.[regex (line %d #%d)]" % (pstate.prefix, pstate.line_no, pstate.implicit())
         ConcatSymbol.__init__(self, name, pstate, no_prefix=True)
         self.can_terminate = True
+        self._parts = () # (text, chars, min_, max_, table) for each part, see compile()
+
+    def compile(self, grmr):
+        # Flatten the child symbols into parts which generate() can expand in one step, instead of pushing each
+        # character through the symstack. Each part is either text (chars is None), or a character set given as a
+        # list of characters (or the _TextChoiceSymbol itself, if it is large), repeated between min_ and max_ times.
+        # Sets of latin-1 characters which can be repeated BATCH_MIN times or more also get a translation table from
+        # random bytes to characters, with bytes from the remainder of 256 % len(chars) deleted to keep it uniform.
+        parts = []
+        for child in self:
+            child = grmr.symtab[child]
+            min_ = max_ = 1
+            if isinstance(child, RepeatSymbol):
+                min_, max_ = child.min_, child.max_
+                child = grmr.symtab[child[0]]
+            if isinstance(child, TextSymbol):
+                if min_ == max_ == 1 and parts and parts[-1][1] is None and parts[-1][2] == parts[-1][3] == 1:
+                    parts[-1] = (parts[-1][0] + child.value, None, 1, 1, None) # join consecutive text
+                else:
+                    parts.append((child.value, None, min_, max_, None))
+            elif len(child) <= self.ALPHABET_MAX:
+                chars, table = list(child), None
+                if max_ >= self.BATCH_MIN and chars[-1] < 256:
+                    n_chars = len(chars)
+                    table = (bytes(bytearray(chars[byte % n_chars] for byte in range(256))),
+                             bytes(bytearray(range(256 - 256 % n_chars, 256))))
+                parts.append((None, [unichr_(char) for char in chars], min_, max_, table))
+            else:
+                parts.append((None, child, min_, max_, None))
+        self._parts = tuple(parts)
+        return ConcatSymbol.compile(self, grmr)
+
+    def generate(self, gstate):
+        grmr, rng = gstate.grmr, gstate.rng
+        rand = rng.random
+        limit = grmr._limit # pylint: disable=protected-access
+        # same as grmr.is_limit_exceeded(), which is checked before each repeat, but the output isn't appended yet
+        limited = gstate.n_limited > 0
+        length = gstate.length
+        out = []
+        for text, chars, min_, max_, table in self._parts:
+            if min_ == max_:
+                reps = min_
+            elif limited or (limit is not None and length >= limit):
+                reps = min_
+            else:
+                reps = rng.randint(min_, rng.randint(min_, max_)) # ~betavariate(0.75, 2.25)
+            if chars is None:
+                out.append(text * reps)
+                length += len(text) * reps
+            elif table is not None and reps >= self.BATCH_MIN:
+                out.append(_rndtext(rng, table[0], table[1], reps))
+                length += reps
+            elif isinstance(chars, list):
+                n_chars = len(chars)
+                out.extend([chars[int(rand() * n_chars)] for _ in range(reps)])
+                length += reps
+            else:
+                n_chars = len(chars)
+                out.extend([unichr_(chars[int(rand() * n_chars)]) for _ in range(reps)])
+                length += reps
+        out = "".join(out)
+        if out:
+            gstate.append(out)
 
     def _impl_name(self, n_implicit):
         name = "%s.%d]" % (self.name[:-1], n_implicit[0])
@@ -1161,33 +2105,35 @@ class RegexSymbol(ConcatSymbol):
         self.append(rep.name)
 
     @staticmethod
-    def parse(defn, pstate):
+    def parse(defn, pos, pstate):
         result = RegexSymbol(pstate)
         n_implicit = [0]
-        if defn[0] != "/":
+        if defn[pos] != "/":
             raise ParseError("Regex definitions must begin with /")
-        defn = defn[1:]
-        while defn:
-            match = RegexSymbol._RE_PARSE.match(defn)
+        pos += 1
+        end = len(defn)
+        while pos < end:
+            match = RegexSymbol._RE_PARSE.match(defn, pos)
             if match is None:
-                result.new_text(defn[0], n_implicit, pstate)
-                defn = defn[1:]
+                result.new_text(defn[pos], n_implicit, pstate)
+                pos += 1
             elif match.group("set"):
                 lst = _TextChoiceSymbol(result._impl_name(n_implicit), pstate, no_prefix=True)
                 inverse = len(match.group("set")) == 2
-                defn = defn[match.end(0):]
+                pos = match.end(0)
                 alpha = []
+                ranges = []
                 in_range = False
-                while defn:
-                    match = RegexSymbol._RE_SET.match(defn)
+                while pos < end:
+                    match = RegexSymbol._RE_SET.match(defn, pos)
                     if match.group(0) == "]":
                         if in_range:
                             alpha.append(ord('-'))
-                        defn = defn[match.end(0):]
+                        pos = match.end(0)
                         break
                     elif match.group(0) == "-":
                         if in_range or not alpha:
-                            raise ParseError("Parse error in regex at: %s" % defn)
+                            raise ParseError("Parse error in regex at: %s" % defn[pos:])
                         in_range = True
                     else:
                         if match.group(0).startswith("\\"):
@@ -1198,47 +2144,49 @@ class RegexSymbol(ConcatSymbol):
                         else:
                             alpha.append(ord(match.group(0)))
                         if in_range:
-                            end = alpha.pop()
-                            start = alpha.pop()
-                            if start >= end + 1:
-                                raise ParseError("Empty range in regex at: %s" % defn)
-                            lst.add(start, end)
+                            last = alpha.pop()
+                            first = alpha.pop()
+                            if first >= last + 1:
+                                raise ParseError("Empty range in regex at: %s" % defn[pos:])
+                            ranges.append((first, last))
                             in_range = False
-                    defn = defn[match.end(0):]
+                    pos = match.end(0)
                 else:
                     raise ParseError("Unterminated set in regex")
-                for char in alpha:
-                    lst.add(char)
+                ranges.extend((char, char) for char in alpha)
+                lst.add_ranges(ranges)
                 if inverse:
                     sub = SparseList(lst)
                     lst.clear()
                     lst.add(ord(" "), ord("~"))
                     lst -= sub
+                if not lst:
+                    raise ParseError("Empty set in regex")
                 result.append(lst.name)
             elif match.group("done"):
-                return result, defn[match.end(0):]
+                return result, match.end(0)
             elif match.group("dot"):
                 try:
-                    pstate.grmr.symtab["%s.[regex alpha]" % pstate.prefix]
+                    sym = pstate.grmr.symtab["%s.[regex alpha]" % pstate.prefix]
                 except KeyError:
                     sym = _TextChoiceSymbol("[regex alpha]", pstate)
                     sym.add(ord(" "), ord("~"))
                     sym.line_no = 0
                 result.append(sym.name)
-                defn = defn[match.end(0):]
+                pos = match.end(0)
             elif match.group("esc"):
                 result.new_text(TextSymbol.ESCAPES.get(match.group(0)[1], match.group(0)[1]), n_implicit, pstate)
-                defn = defn[match.end(0):]
+                pos = match.end(0)
             else: # repeat
                 if not len(result) or isinstance(pstate.grmr.symtab[result[-1]], RepeatSymbol):
-                    raise ParseError("Error parsing regex, unexpected repeat at: %s" % defn)
+                    raise ParseError("Error parsing regex, unexpected repeat at: %s" % defn[pos:])
                 if match.group("a"):
                     min_ = int(match.group("a"))
                     max_ = int(match.group("b")) if match.group("b") else min_
                 else:
                     min_, max_ = 0, 1
                 result.add_repeat(min_, max_, n_implicit, pstate)
-                defn = defn[match.end(0):]
+                pos = match.end(0)
         raise ParseError("Unterminated regular expression")
 
 
@@ -1261,6 +2209,13 @@ class RepeatSymbol(ConcatSymbol):
         name = "%s.%s" % (pstate.prefix, name) if not no_prefix else name
         ConcatSymbol.__init__(self, name, pstate, no_prefix=True)
         self.min_, self.max_ = min_, max_
+        self._id = None
+
+    OPCODE = _OP_CALL
+
+    def compile(self, grmr):
+        self._id = grmr._ids[self.name] # pylint: disable=protected-access
+        return ConcatSymbol.compile(self, grmr)
 
     def normalize(self, grmr):
         if isinstance(self, RepeatSampleSymbol) or self.min_ == "*" or self.max_ == "*":
@@ -1282,16 +2237,23 @@ class RepeatSymbol(ConcatSymbol):
             if not self.can_terminate:
                 return # chop the output. this isn't great, but not much choice
             reps = self.min_
+        elif self.min_ == self.max_:
+            reps = self.min_ # no random choice, so fixed repeats generate the same as when folded by optimize()
         else:
-            reps = random.randint(self.min_, random.randint(self.min_, self.max_)) # roughly betavariate(0.75, 2.25)
-        gstate.symstack.extend(reps * tuple(reversed(self)))
+            reps = gstate.rng.randint(self.min_, gstate.rng.randint(self.min_, self.max_)) # ~betavariate(0.75, 2.25)
+        # push one iteration at a time, the rest are pushed by the "repeat" command in Grammar._expand()
+        if reps > 1:
+            gstate.symstack.append(("repeat", self._id, 1, reps))
+        if reps:
+            gstate.symstack.extend(self._ids)
 
     def update_can_terminate(self, grmr):
         if _Symbol.update_can_terminate(self, grmr):
             return True
         if self.min_ == 0:
             self.can_terminate = True
-            log.debug("%s can terminate", self.name)
+            if grmr._trace: # pylint: disable=protected-access
+                log.debug("%s can terminate", self.name)
             return True
         return False
 
@@ -1322,11 +2284,11 @@ class RepeatSampleSymbol(RepeatSymbol):
                 return # chop the output. this isn't great, but not much choice
             reps = self.min_
         else:
-            reps = random.randint(self.min_, random.randint(self.min_, self.max_)) # roughly betavariate(0.75, 2.25)
+            reps = gstate.rng.randint(self.min_, gstate.rng.randint(self.min_, self.max_)) # ~betavariate(0.75, 2.25)
         # sample the choice (which gives cache values for the symstack), then generate self that many times
         assert self.choice is not None
         for choices in reversed(gstate.grmr.symtab[self.choice].sample(reps, gstate)):
-            gstate.symstack.extend(reversed(self))
+            gstate.symstack.extend(self._ids)
             gstate.symstack.extend(choices)
 
 
@@ -1355,6 +2317,7 @@ class TextSymbol(_Symbol):
 
     _RE_QUOTE = re.compile(r"""(?P<end>["'])|\\(?P<esc>.)""")
     ESCAPES = {"0": "\0", "a": "\a", "b": "\b", "t": "\t", "n": "\n", "v": "\v", "f": "\f", "r": "\r", "e": "\x1b"}
+    OPCODE = _OP_TEXT
 
     def __init__(self, name, value, pstate, no_prefix=False, no_add=False):
         if name is None:
@@ -1364,16 +2327,19 @@ class TextSymbol(_Symbol):
         self.value = str(value)
         self.can_terminate = True
 
+    def compile(self, grmr):
+        return self.value
+
     def generate(self, gstate):
         gstate.append(self.value)
 
     @staticmethod
-    def parse(defn, pstate, no_add=False):
-        qchar, defn = defn[0], defn[1:]
+    def parse(defn, pos, pstate, no_add=False):
+        qchar = defn[pos]
         if qchar not in "'\"":
-            raise ParseError("Error parsing string, expected \" or ' at: %s%s" % (qchar, defn))
-        out, last = [], 0
-        for match in TextSymbol._RE_QUOTE.finditer(defn):
+            raise ParseError("Error parsing string, expected \" or ' at: %s" % defn[pos:])
+        out, last = [], pos + 1
+        for match in TextSymbol._RE_QUOTE.finditer(defn, pos + 1):
             out.append(defn[last:match.start(0)])
             last = match.end(0)
             if match.group("end") == qchar:
@@ -1384,9 +2350,8 @@ class TextSymbol(_Symbol):
                 out.append(TextSymbol.ESCAPES.get(match.group("esc"), match.group("esc")))
         else:
             raise ParseError("Unterminated string literal!")
-        defn = defn[last:]
         sym = TextSymbol(None, "".join(out), pstate, no_add=no_add)
-        return sym, defn
+        return sym, last
 
 
 class _TextChoiceSymbol(_Symbol, SparseList):
@@ -1400,7 +2365,7 @@ class _TextChoiceSymbol(_Symbol, SparseList):
         self.can_terminate = True
 
     def generate(self, gstate):
-        gstate.append(unichr_(self[random.randint(0, len(self) - 1)]))
+        gstate.append(unichr_(self[gstate.rng.randint(0, len(self) - 1)]))
 
 
 def main(argv=None):
@@ -1427,9 +2392,28 @@ def main(argv=None):
     argp.add_argument("-f", "--function", action="append", nargs=2, default=[],
                       help="Function used in the grammar (eg. -f filter lambda x:x.replace('x','y')")
     argp.add_argument("-l", "--limit", type=int, default=DEFAULT_LIMIT, help="Set a generation limit (roughly)")
+    argp.add_argument("-s", "--seed", type=int, help="Seed for generation (the same seed gives the same output)")
+    argp.add_argument("-c", "--cache-dir", help="Directory to cache the compiled grammar in, for faster loading")
+    argp.add_argument("-m", "--max-instances", type=int,
+                      help="Keep at most this many instances of each referenced symbol (default: all)")
+    argp.add_argument("-p", "--profile", action="store_true",
+                      help="Print the count, length and time of each symbol generated to stderr")
+    argp.add_argument("--flamegraph", type=_SafeFileType('w'),
+                      help="Write the self time of each chain of symbols generated, in the collapsed stack format read "
+                           "by flamegraph tools (implies --profile)")
     args = argp.parse_args(argv)
+    if args.max_instances is not None and args.max_instances < 1:
+        argp.error("--max-instances must be at least 1")
     args.function = {func: eval(defn) for (func, defn) in args.function}
-    args.output.write(Grammar(args.input, limit=args.limit, **args.function).generate())
+    grmr = Grammar(args.input, limit=args.limit, cache_dir=args.cache_dir, max_instances=args.max_instances,
+                   **args.function)
+    profile = GenerationProfile(grmr) if args.profile or args.flamegraph else None
+    grmr.generate_to(args.output, seed=args.seed, profile=profile)
+    if profile is not None:
+        sys.stderr.write(profile.report())
+    if args.flamegraph is not None:
+        with args.flamegraph:
+            args.flamegraph.write(profile.collapsed())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,80 @@
+# coding=utf-8
+################################################################################
+#
+# Description: Weighted sampling without replacement using a Fenwick tree
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+################################################################################
+
+from __future__ import unicode_literals
+
+
+class FenwickSampler(object):
+    """Weighted sampling without replacement over a fixed list of weights.
+       The weights are stored in a Fenwick (binary indexed) tree, so each draw and removal is O(log n). The tree is
+       never modified after construction: removals made during sample() are kept in a sparse overlay local to that
+       call, so one sampler can be shared by concurrent callers.
+
+       `total` is the sum of all weights.
+    """
+    def __init__(self, weights):
+        """Build the tree for `weights`, a sequence of non-negative numbers. Zero weight indices are never drawn."""
+        self._weights = list(weights)
+        n = len(self._weights)
+        tree = [0.0] + [float(w) for w in self._weights]
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._top = 1 << (n.bit_length() - 1) if n else 0
+        self._count = sum(1 for w in self._weights if w > 0)
+        self.total = float(sum(self._weights))
+
+    def __len__(self):
+        """Return the number of weights, including those which are zero."""
+        return len(self._weights)
+
+    def sample(self, k, rng):
+        """Return a list of up to `k` unique indices, drawn in order with probability proportional to weight.
+           Fewer than `k` are returned if there are not enough indices with non-zero weight. `rng` is the
+           random.Random instance used for the draws.
+        """
+        tree, weights, n, top = self._tree, self._weights, len(self._weights), self._top
+        delta, removed, result = {}, set(), []
+        total, remaining = self.total, self._count
+        while len(result) < k and remaining:
+            target = rng.uniform(0, total)
+            # find the first index where the prefix sum exceeds target
+            pos, step = 0, top
+            while step:
+                nxt = pos + step
+                if nxt <= n:
+                    value = tree[nxt] + delta.get(nxt, 0.0)
+                    if value <= target:
+                        pos = nxt
+                        target -= value
+                step >>= 1
+            if pos >= n or pos in removed or not weights[pos] > 0:
+                # float rounding put us on an empty slot, take the nearest index that is still available
+                pos = min(range(n), key=lambda i, p=pos: (i in removed or not weights[i] > 0, abs(i - p)))
+            result.append(pos)
+            removed.add(pos)
+            remaining -= 1
+            weight = weights[pos]
+            total -= weight
+            i = pos + 1
+            while i <= n:
+                delta[i] = delta.get(i, 0.0) - weight
+                i += i & -i
+        return result
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding=utf-8
+################################################################################
+#
+# Description: Serve generated testcases from a warm Grammar over HTTP or a unix socket
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+################################################################################
+
+from __future__ import unicode_literals
+import argparse
+import collections
+import io
+import json
+import logging
+import os
+import threading
+import timeit
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import queue
+    import socketserver
+except ImportError: # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer # pylint: disable=import-error
+    import Queue as queue # pylint: disable=import-error
+    import SocketServer as socketserver # pylint: disable=import-error
+
+from .core import DEFAULT_LIMIT, Grammar
+
+
+__all__ = ("PrefetchQueue", "make_server")
+
+
+log = logging.getLogger("avalanche.serve") # pylint: disable=invalid-name
+
+
+DEFAULT_QUEUE_SIZE = 64
+
+
+class PrefetchQueue(object):
+    """Pre-generate testcases from a Grammar into a bounded queue using background threads.
+       Workers block when the queue is full, so generation never runs more than `size` testcases ahead of requests.
+    """
+
+    def __init__(self, grmr, size=DEFAULT_QUEUE_SIZE, workers=1, start="root"):
+        self.grmr = grmr
+        self.start = start
+        self._queue = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=10000) # seconds waited by recent get() calls
+        self.generated = 0
+        self.served = 0
+        self.errors = 0
+        self._workers = [threading.Thread(target=self._work, name="avalanche-worker-%d" % i) for i in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                result = self.grmr.generate(self.start)
+            except Exception as exc: # pylint: disable=broad-except
+                log.error("generation failed: %s", exc)
+                result = exc
+            with self._lock:
+                self.generated += 1
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """Return the next testcase, waiting for one to be generated if the queue is empty.
+           Raises the exception from generation if that testcase failed.
+        """
+        started = timeit.default_timer()
+        result = self._queue.get()
+        with self._lock:
+            self._latencies.append(timeit.default_timer() - started)
+            if isinstance(result, Exception):
+                self.errors += 1
+            else:
+                self.served += 1
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stats(self):
+        """Return a dict of counters, queue depth and p50/p99 wait time (in ms) of recent requests."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            result = {"generated": self.generated, "served": self.served, "errors": self.errors,
+                      "queued": self._queue.qsize()}
+        for pct in (50, 99):
+            value = latencies[min(len(latencies) - 1, len(latencies) * pct // 100)] if latencies else 0.0
+            result["p%d_ms" % pct] = round(value * 1000, 3)
+        return result
+
+    def stop(self):
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+
+
+def _encode(testcase):
+    if isinstance(testcase, bytes):
+        return testcase, "application/octet-stream"
+    return testcase.encode("utf-8"), "text/plain; charset=utf-8"
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self): # pylint: disable=invalid-name
+        if self.path == "/stats":
+            body, ctype = json.dumps(self.server.testcases.stats(), sort_keys=True).encode("ascii"), "application/json"
+        elif self.path in {"/", "/testcase"}:
+            try:
+                body, ctype = _encode(self.server.testcases.get())
+            except Exception as exc: # pylint: disable=broad-except
+                # already logged by PrefetchQueue
+                self.send_error(500, "generation failed: %s" % exc)
+                return
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        log.debug("%s - %s", self.address_string(), format % args)
+
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+    """Write one testcase to each connection, then close it."""
+
+    def handle(self):
+        try:
+            body = _encode(self.server.testcases.get())[0]
+        except Exception: # pylint: disable=broad-except
+            # already logged by PrefetchQueue, and there is no way to report an error in the protocol, so the
+            # connection is closed without a testcase
+            return
+        self.wfile.write(body)
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, testcases):
+        HTTPServer.__init__(self, address, handler)
+        self.testcases = testcases
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, address, handler, testcases):
+            socketserver.UnixStreamServer.__init__(self, address, handler)
+            self.testcases = testcases
+else: # windows
+    _UnixServer = None # pylint: disable=invalid-name
+
+
+def make_server(testcases, host="127.0.0.1", port=8000, unix=None):
+    """Create a server for testcases from a PrefetchQueue.
+       If `unix` is given, each connection to that socket path receives one testcase. Otherwise testcases are served
+       over HTTP from ``GET /``, with stats as JSON from ``GET /stats``.
+    """
+    if unix is not None:
+        if _UnixServer is None:
+            raise ValueError("unix sockets are not supported on this platform")
+        return _UnixServer(unix, _UnixHandler, testcases)
+    return _HTTPServer((host, port), _HTTPHandler, testcases)
+
+
+def main(argv=None):
+
+    logging.basicConfig(level=logging.INFO)
+    if bool(os.getenv("DEBUG")):
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    argp = argparse.ArgumentParser(prog="python -m avalanche serve",
+                                   description="Serve testcases generated from a grammar")
+    argp.add_argument("input", help="Input grammar definition")
+    argp.add_argument("-f", "--function", action="append", nargs=2, default=[],
+                      help="Function used in the grammar (eg. -f filter lambda x:x.replace('x','y')")
+    argp.add_argument("-l", "--limit", type=int, default=DEFAULT_LIMIT, help="Set a generation limit (roughly)")
+    argp.add_argument("-m", "--max-instances", type=int,
+                      help="Keep at most this many instances of each referenced symbol (default: all)")
+    argp.add_argument("-H", "--host", default="127.0.0.1", help="Address to serve HTTP on (default: 127.0.0.1)")
+    argp.add_argument("-p", "--port", type=int, default=8000, help="Port to serve HTTP on (default: 8000)")
+    argp.add_argument("-u", "--unix", help="Serve on a unix socket at this path instead of HTTP")
+    argp.add_argument("-q", "--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                      help="Number of testcases to generate ahead (default: %d)" % DEFAULT_QUEUE_SIZE)
+    argp.add_argument("-w", "--workers", type=int, default=1, help="Number of generation threads (default: 1)")
+    args = argp.parse_args(argv)
+    if args.unix is not None and _UnixServer is None:
+        argp.error("unix sockets are not supported on this platform")
+    if args.max_instances is not None and args.max_instances < 1:
+        argp.error("--max-instances must be at least 1")
+    args.function = {func: eval(defn) for (func, defn) in args.function}
+    with io.open(args.input, encoding="utf-8") as grammar:
+        grmr = Grammar(grammar, limit=args.limit, max_instances=args.max_instances, **args.function)
+
+    testcases = PrefetchQueue(grmr, size=args.queue_size, workers=args.workers)
+    server = make_server(testcases, host=args.host, port=args.port, unix=args.unix)
+    if args.unix is not None:
+        log.info("serving testcases on unix socket %s", args.unix)
+    else:
+        log.info("serving testcases on http://%s:%d/", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        testcases.stop()
+        if args.unix is not None and os.path.exists(args.unix):
+            os.unlink(args.unix)
+        log.info("stats: %s", json.dumps(testcases.stats(), sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,20 +15,34 @@
 ################################################################################
 
 from __future__ import unicode_literals
+from array import array
 import bisect
 
 
+_TYPECODE = str("l") # at least 32-bit signed, enough for any code point
+
+
 class SparseList(object):
     """List-like numeric array type which supports sparse ranges.
        Maintains sorted order, and supports indexing within sparse ranges.
        Ranges cannot overlap (raises ValueError).
+       Ranges are stored as parallel arrays of inclusive start and end values.
     """
     def __init__(self, copy=None):
         if copy is None:
             self.clear()
         else:
-            self._data = copy._data
+            self._starts = array(_TYPECODE, copy._starts)
+            self._ends = array(_TYPECODE, copy._ends)
             self._len = copy._len
+            self._offsets = copy._offsets
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Create a SparseList from an iterable of inclusive (a,b) ranges, in any order."""
+        result = cls()
+        result.add_ranges(ranges)
+        return result
 
     def add(self, a, b=None):
         """
@@ -38,28 +52,51 @@ class SparseList(object):
             b = a
         elif b < a:
             raise ValueError("Only forward intervals are supported (a <= b)")
-        insert = bisect.bisect_left(self._data, [a])
-        # check before for conflict
-        if insert and a <= self._data[insert - 1][1]:
-            raise ValueError("%d is already present in the list" % a)
-        # check after for conflict
-        if insert < len(self._data) and b >= self._data[insert][0]:
-            raise ValueError("%d is already present in the list" % b)
-        # check for pre-optimize
-        pre = insert and a == self._data[insert - 1][1] + 1
-        # check for post optimize
-        post = insert < len(self._data) and b + 1 == self._data[insert][0]
+        starts, ends = self._starts, self._ends
+        # first range which ends at or after a
+        insert = bisect.bisect_left(ends, a)
+        if insert < len(starts) and starts[insert] <= b:
+            raise ValueError("%d is already present in the list" % (a if starts[insert] <= a else b))
+        self._offsets = None
+        pre = insert and a == ends[insert - 1] + 1
+        post = insert < len(starts) and b + 1 == starts[insert]
         if pre and post:
-            self._data[insert - 1][1] = self._data[insert][1]
-            self._data.pop(insert)
+            ends[insert - 1] = ends[insert]
+            del starts[insert]
+            del ends[insert]
         elif pre:
-            self._data[insert - 1][1] = b
+            ends[insert - 1] = b
         elif post:
-            self._data[insert][0] = a
+            starts[insert] = a
         else:
-            self._data.insert(insert, [a, b])
+            starts.insert(insert, a)
+            ends.insert(insert, b)
         self._len += b - a + 1
 
+    def add_ranges(self, ranges):
+        """
+        Add many inclusive (a,b) ranges at once. This sorts and merges all ranges in one pass, rather than inserting
+        them one at a time.
+        """
+        new = sorted(ranges)
+        for a, b in new:
+            if b < a:
+                raise ValueError("Only forward intervals are supported (a <= b)")
+        if self._starts:
+            new = sorted(new + list(zip(self._starts, self._ends)))
+        starts, ends = array(_TYPECODE), array(_TYPECODE)
+        length = 0
+        for a, b in new:
+            if ends and a <= ends[-1]:
+                raise ValueError("%d is already present in the list" % a)
+            if ends and a == ends[-1] + 1:
+                ends[-1] = b
+            else:
+                starts.append(a)
+                ends.append(b)
+            length += b - a + 1
+        self._starts, self._ends, self._len, self._offsets = starts, ends, length, None
+
     def remove(self, a, b=None):
         """
         Remove range (a,b) inclusive. If b is not specified, default to (a,a).
@@ -69,71 +106,81 @@ class SparseList(object):
             b = a
         if b < a:
             raise ValueError("Only forward intervals are supported (a <= b)")
-        ia = bisect.bisect_left(self._data, [a])
-        ib = bisect.bisect_left(self._data, [b])
-        # move a if needed
-        if ia and a <= self._data[ia - 1][1]:
-            #a is actually in the range before ia
-            ia -= 1
-        elif ia != len(self._data) and a < self._data[ia][0]:
-            a = self._data[ia][0]
-        if ia == len(self._data):
+        starts, ends = self._starts, self._ends
+        # ranges [first, last) overlap (a,b)
+        first = bisect.bisect_left(ends, a)
+        last = bisect.bisect_right(starts, b)
+        if first >= last:
             return
-        ahead = bool(self._data[ia][0] == a)
-        # move b if needed
-        if ib and b <= self._data[ib - 1][1]:
-            #b is actually in the range before ib
-            ib -= 1
-        elif ib and b > self._data[ib - 1][1] and ib != len(self._data) and b < self._data[ib][0]:
-            b = self._data[ib - 1][1]
-            ib -= 1
-        if b < a:
-            return
-        btail = bool(self._data[ib][1] == b)
-        # do the deletions
-        if ahead and btail:
-            # delete whole range
-            self._len -= sum((j - i + 1) for (i, j) in self._data[ia:ib + 1])
-            del self._data[ia:ib + 1]
-        elif btail:
-            # modify ia
-            self._len -= self._data[ia][1] - a + 1 + sum((j - i + 1) for (i, j) in self._data[ia + 1:ib + 1])
-            self._data[ia][1] = a - 1
-            del self._data[ia + 1:ib + 1]
-        elif ahead:
-            # modify ib
-            self._len -= b - self._data[ib][0] + 1 + sum((j - i + 1) for (i, j) in self._data[ia:ib])
-            self._data[ib][0] = b + 1
-            del self._data[ia:ib]
-        elif ia == ib:
-            new = [b + 1, self._data[ib][1]]
-            self._len -= self._data[ib][1] - a + 1
-            self._data[ib][1] = a - 1
-            self.add(*new)
-        else:
-            self._len -= b - self._data[ib][0] + self._data[ia][1] - a + 2
-            self._len -= sum((j - i + 1) for (i, j) in self._data[ia + 1:ib])
-            self._data[ia][1] = a - 1
-            self._data[ib][0] = b + 1
-            del self._data[ia + 1:ib]
+        self._offsets = None
+        for i in range(first, last):
+            self._len -= min(ends[i], b) - max(starts[i], a) + 1
+        new_starts, new_ends = array(_TYPECODE), array(_TYPECODE)
+        if starts[first] < a:
+            new_starts.append(starts[first])
+            new_ends.append(a - 1)
+        if ends[last - 1] > b:
+            new_starts.append(b + 1)
+            new_ends.append(ends[last - 1])
+        starts[first:last] = new_starts
+        ends[first:last] = new_ends
+
+    def ranges(self):
+        """Return a list of the inclusive (a,b) ranges in the list."""
+        return list(zip(self._starts, self._ends))
 
     def clear(self):
         self._len = 0
-        self._data = []
+        self._starts = array(_TYPECODE)
+        self._ends = array(_TYPECODE)
+        self._offsets = None # index of the first element in each range, built on demand by __getitem__
 
     def __isub__(self, other):
-        for (a, b) in other._data:
-            self.remove(a, b)
+        # single pass over both sorted range lists
+        starts, ends = array(_TYPECODE), array(_TYPECODE)
+        length = 0
+        sub_starts, sub_ends = other._starts, other._ends
+        j, n_sub = 0, len(sub_starts)
+        for a, b in zip(self._starts, self._ends):
+            while j < n_sub and sub_ends[j] < a:
+                j += 1
+            k = j
+            while a <= b:
+                if k >= n_sub or sub_starts[k] > b:
+                    starts.append(a)
+                    ends.append(b)
+                    length += b - a + 1
+                    break
+                if sub_starts[k] > a:
+                    starts.append(a)
+                    ends.append(sub_starts[k] - 1)
+                    length += sub_starts[k] - a
+                a = max(a, sub_ends[k] + 1)
+                k += 1
+        self._starts, self._ends, self._len, self._offsets = starts, ends, length, None
         return self
 
+    def __iter__(self):
+        for a, b in zip(self._starts, self._ends):
+            for value in range(a, b + 1):
+                yield value
+
     def __len__(self):
         return self._len
 
+    def _build_offsets(self):
+        offsets, total = [], 0
+        for a, b in zip(self._starts, self._ends):
+            offsets.append(total)
+            total += b - a + 1
+        self._offsets = offsets
+        return offsets
+
     def __getitem__(self, key):
         if key >= len(self) or key < 0:
             [][0] # raise IndexError
-        for a, b in self._data:
-            len_ = b - a + 1
-            if key < len_:
-                return a + key
-            key -= len_
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._build_offsets()
+        i = bisect.bisect_right(offsets, key) - 1
+        return self._starts[i] + key - offsets[i]
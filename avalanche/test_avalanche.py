@@ -21,16 +21,32 @@
 
 from __future__ import unicode_literals
 import io
+import json
 import logging
 import os
+import random
 import re
 import shutil
+import socket
 import string
 import sys
 import tempfile
+import threading
 import unittest
 
-from avalanche.core import Grammar, GenerationError, IntegrityError, main, ParseError, SparseList, unichr_
+import avalanche.core
+from avalanche.core import Grammar, GenerationError, GenerationProfile, IntegrityError, main, ParseError, SparseList
+from avalanche.core import unichr_
+from avalanche.core import BinSymbol, ConcatSymbol, TextSymbol
+from avalanche.core import _GenState, _ParseState
+from avalanche.fenwick import FenwickSampler
+from avalanche.serve import PrefetchQueue, make_server
+import avalanche.serve
+
+try:
+    from urllib.request import urlopen
+except ImportError: # python 2
+    from urllib2 import urlopen # pylint: disable=import-error
 
 
 logging.basicConfig(level=logging.DEBUG if bool(os.getenv("DEBUG")) else logging.INFO)
@@ -41,6 +57,11 @@ log = logging.getLogger("avalanche_test")
 DELTA = 0.05
 
 
+def reverse(value):
+    # module level so it can be pickled for generate_parallel() workers that don't fork
+    return value[::-1]
+
+
 class TestCase(unittest.TestCase):
 
     def setUp(self):
@@ -143,6 +164,84 @@ class Binary(TestCase):
         with self.assertRaisesRegex(ParseError, r'^Invalid hex string'):
             Grammar("root x'000ü'")
 
+    def test_output_type(self):
+        "test that the output type is decided when the grammar is compiled"
+        gmr = Grammar("root (a) @1 @a (a) @2\n"
+                      "a 1 x'41'\n"
+                      "  1 x'42'")
+        self.assertIs(gmr._output_type, bytes)
+        for _ in range(20):
+            self.assertRegex(gmr.generate(), br"^([AB])\1[AB]([AB])\2$")
+        chunks = list(gmr.generate_iter(chunk_size=1))
+        self.assertTrue(all(isinstance(chunk, bytes) for chunk in chunks))
+        self.assertRegex(b"".join(chunks), br"^([AB])\1[AB]([AB])\2$")
+        self.assertIs(Grammar("root 'a' rndint(1,2)")._output_type, type(""))
+        # either type can be generated, so it's checked for each value
+        gmr = Grammar("root a\n"
+                      "a 1 x'41'\n"
+                      "  1 'B'")
+        self.assertIsNone(gmr._output_type)
+        self.assertEqual({gmr.generate() for _ in range(50)}, {b"A", "B"})
+        gmr = Grammar("root x'41' 'B'")
+        with self.assertRaisesRegex(GenerationError, r"^Wrong value type generated"):
+            gmr.generate()
+
+
+class Cache(TestCase):
+
+    def test_0(self):
+        "test that a cached grammar is used and invalidated when an import changes"
+        with open("a.gmr", "w") as fd:
+            fd.write("a /[0-9]{10}/\n")
+        with open("b.gmr", "w") as fd:
+            fd.write("b    import('c.gmr')\n"
+                     "a    import('a.gmr')\n"
+                     "root (x) @x f(a.a)\n"
+                     "x    'X' b.b\n")
+        with open("c.gmr", "w") as fd:
+            fd.write("b 'B'\n")
+
+        def load():
+            with open("b.gmr") as fd:
+                return Grammar(fd, cache_dir="cache", f=lambda x: x.upper())
+
+        gmr = load()
+        self.assertEqual(len(os.listdir("cache")), 1)
+        self.assertRegex(gmr.generate(), r"^XBXB[0-9]{10}$")
+        parse = Grammar.parse
+        Grammar.parse = None # cached load must not parse
+        try:
+            cached = load()
+        finally:
+            Grammar.parse = parse
+        self.assertEqual(cached.hash, gmr.hash)
+        self.assertEqual(cached.generate(seed=1), gmr.generate(seed=1))
+        with self.assertRaisesRegex(IntegrityError, r"^Function f used but not defined"):
+            with open("b.gmr") as fd:
+                Grammar(fd, cache_dir="cache")
+        with open("c.gmr", "w") as fd:
+            fd.write("b 'C'\n")
+        changed = load()
+        self.assertNotEqual(changed.hash, gmr.hash)
+        self.assertRegex(changed.generate(), r"^XCXC[0-9]{10}$")
+        with open("b.gmr") as fd:
+            self.assertRegex(Grammar(fd, cache_dir="cache", f=lambda x: x).generate(), r"^XCXC[0-9]{10}$")
+
+    def test_1(self):
+        "test that a corrupt cache file is ignored"
+        gmr = Grammar("root 'A'", cache_dir="cache")
+        cache_fn = os.path.join("cache", os.listdir("cache")[0])
+        with open(cache_fn, "wb") as fd:
+            fd.write(b"garbage")
+        self.assertEqual(Grammar("root 'A'", cache_dir="cache").generate(), gmr.generate())
+
+    def test_2(self):
+        "test that the output type of a cached grammar follows the functions passed when loading"
+        self.assertIs(Grammar("root rndint(1,5)", cache_dir="cache")._output_type, type(""))
+        cached = Grammar("root rndint(1,5)", cache_dir="cache", rndint=lambda a, b: b"X")
+        self.assertIsNone(cached._output_type)
+        self.assertEqual(cached.generate(), b"X")
+
 
 class Choices(TestCase):
 
@@ -301,6 +400,41 @@ class Choices(TestCase):
         "test for implicit Choice"
         self.balanced_choice("root ('a' | 'b')", ["a", "b"])
 
+    def test_11(self):
+        "test weights in a choice with many alternatives"
+        iters = 20000
+        gmr = Grammar("root 1 'a'\n"
+                      "     0 'b'\n"
+                      + "".join("     .001 'c%d'\n" % i for i in range(1000)))
+        result = {"a": 0, "b": 0, "c": 0}
+        seen = set()
+        for _ in range(iters):
+            value = gmr.generate()
+            result[value[0]] += 1
+            seen.add(value)
+        self.assertEqual(result["b"], 0)
+        self.assertAlmostEqual(float(result["a"])/iters, 0.5, delta=DELTA)
+        self.assertAlmostEqual(float(result["c"])/iters, 0.5, delta=DELTA)
+        self.assertGreater(len(seen), 900)
+
+    def test_12(self):
+        "test that the count of limited recursive symbols is kept in step with the recursion state"
+        gmr = Grammar("root  a{50}\n"
+                      "a  1  '(' b ')'\n"
+                      "   1  'x'\n"
+                      "b  1  '[' a a ']'\n"
+                      "   1  'y'", limit=None)
+        gstate = _GenState(gmr)
+        limited = 0
+        for seed in range(20):
+            gstate.reset(gmr._ids["root"], seed)
+            for _ in gmr._expand(gstate, 1):
+                self.assertEqual(gstate.n_limited, sum(state["limited"] for state in gstate.recursive_syms.values()))
+                limited = max(limited, gstate.n_limited)
+            self.assertEqual(gstate.n_limited, 0)
+            self.assertEqual(gstate.recursive_syms, {})
+        self.assertGreater(limited, 0)
+
 
 class Concats(TestCase):
 
@@ -316,6 +450,34 @@ class Concats(TestCase):
         self.assertEqual(gmr.generate(), "abc")
 
 
+class FenwickSampler_(TestCase):
+
+    def test_0(self):
+        "test that sampling without replacement returns unique indices with non-zero weight"
+        smp = FenwickSampler([1, 0, 2, 0.5, 0, 3])
+        self.assertEqual(len(smp), 6)
+        for _ in range(100):
+            result = smp.sample(10, random)
+            self.assertEqual(sorted(result), [0, 2, 3, 5])
+        self.assertEqual(len(smp.sample(2, random)), 2)
+        self.assertEqual(FenwickSampler([]).sample(1, random), [])
+
+    def test_1(self):
+        "test that sampling is weighted"
+        iters = 10000
+        smp = FenwickSampler([1, 2, 1])
+        first = [0, 0, 0]
+        second = [0, 0, 0]
+        for _ in range(iters):
+            result = smp.sample(2, random)
+            first[result[0]] += 1
+            second[result[1]] += 1
+        self.assertAlmostEqual(float(first[1])/iters, 0.5, delta=DELTA)
+        self.assertAlmostEqual(float(first[0])/iters, 0.25, delta=DELTA)
+        # P(1 second) = P(0 first) * 2/3 + P(2 first) * 2/3
+        self.assertAlmostEqual(float(second[1])/iters, 1.0/3, delta=DELTA)
+
+
 class Functions(TestCase):
 
     def test_funcs(self):
@@ -470,6 +632,44 @@ class Imports(TestCase):
                       "root b.a")
         self.assertEqual(gmr.generate(), 'A')
 
+    def test_reuse(self):
+        "test that an imported grammar is parsed once and shared by later Grammars"
+        with open("a.gmr", "w") as fd:
+            fd.write("b    import('b.gmr')\n"
+                     "a    'A' b.b /[xyz]/\n"
+                     "t    (a) @a\n")
+        with open("b.gmr", "w") as fd:
+            fd.write("b    'B' /[bB]/\n")
+        Grammar.clear_modules()
+        gmr1 = Grammar("x import('a.gmr')\n"
+                       "root x.t")
+        parsed = []
+        init = _ParseState.__init__
+
+        def counting_init(pstate, prefix, grmr, filename):
+            parsed.append(filename)
+            init(pstate, prefix, grmr, filename)
+
+        _ParseState.__init__ = counting_init
+        try:
+            gmr2 = Grammar("y import('a.gmr')\n"
+                           "root y.t '!'")
+        finally:
+            _ParseState.__init__ = init
+        self.assertEqual(parsed, [None]) # only the top-level grammar is parsed
+        self.assertRegex(gmr1.generate(), r"^(AB[bB][xyz])\1$")
+        self.assertRegex(gmr2.generate(), r"^(AB[bB][xyz])\1!$")
+        # symbols are copied, parsed values are shared
+        text1, text2 = gmr1.symtab[gmr1.symtab["x.b.b"][0]], gmr2.symtab[gmr2.symtab["y.b.b"][0]]
+        self.assertIsNot(text1, text2)
+        self.assertIs(text1.value, text2.value)
+        # a change to a nested import is seen
+        with open("b.gmr", "w") as fd:
+            fd.write("b    'C' /[bB]/\n")
+        gmr3 = Grammar("y import('a.gmr')\n"
+                       "root y.t '!'")
+        self.assertRegex(gmr3.generate(), r"^(AC[bB][xyz])\1!$")
+
     def test_nested(self):
         "test that circular imports are allowed"
         with open('a.gmr', 'w') as fd:
@@ -483,6 +683,21 @@ class Imports(TestCase):
             gmr = Grammar(fd)
         self.assertEqual(gmr.generate(), "AA")
 
+    def test_nested_reuse(self):
+        "test that circular imports can be loaded from either file when the parsed files are reused"
+        with open("a.gmr", "w") as fd:
+            fd.write("b import('b.gmr')\n"
+                     "x 'X' b.y\n"
+                     "w 'W' /[a-c]/\n")
+        with open("b.gmr", "w") as fd:
+            fd.write("a import('a.gmr')\n"
+                     "y 'Y' /[0-9]/\n"
+                     "z a.w 'Z'\n")
+        Grammar.clear_modules()
+        self.assertRegex(Grammar("b import('b.gmr')\nroot b.z\n").generate(), r"^W[a-c]Z$")
+        self.assertRegex(Grammar("a import('a.gmr')\nroot a.x\n").generate(), r"^XY[0-9]$")
+        self.assertRegex(Grammar("b import('b.gmr')\nroot b.z\n").generate(), r"^W[a-c]Z$")
+
     def test_recursive_defn(self):
         "test that infinite recursion is detected across an import"
         with open('b.gmr', 'w') as fd:
@@ -591,6 +806,163 @@ class Inputs(TestCase):
         self.assertEqual(gmr.generate(), 'aü')
 
 
+class Optimize(TestCase):
+
+    def test_fold(self):
+        "test that constant symbols are folded to text, except tracked symbols"
+        gmr = Grammar("root   a ('<' c '>') d @d (e) @1 f /x{3}y/ g\n"
+                      "a      '<' '/' 'div' '>'\n"
+                      "c      'c'{3}\n"
+                      "d      'd'\n"
+                      "e      'e' 'e'\n"
+                      "f      eval('a')\n"
+                      "g      'g' /[gG]/\n")
+        self.assertIsInstance(gmr.symtab["a"], TextSymbol)
+        self.assertEqual(gmr.symtab["a"].value, "</div>")
+        self.assertEqual(gmr.symtab["c"].value, "ccc")
+        self.assertIsInstance(gmr.symtab["d"], ConcatSymbol) # referenced
+        self.assertIsInstance(gmr.symtab["g"], ConcatSymbol)
+        self.assertGreaterEqual(gmr.optimize_stats["folded"], 5)
+        for _ in range(10):
+            self.assertRegex(gmr.generate(), r"^</div><ccc>ddee<ccc></div>xxxyg[gG]$")
+        gmr = Grammar("root   b x'43'\n"
+                      "b      x'41' x'42'\n")
+        self.assertIsInstance(gmr.symtab["b"], BinSymbol)
+        self.assertEqual(gmr.symtab["root"].value, b"ABC")
+        self.assertEqual(gmr.generate(), b"ABC")
+        # symbols which generate nothing are dropped, not folded to "" (which isn't bytes)
+        self.assertEqual(Grammar("root x'41' 'a'{0}\n").generate(), b"A")
+        self.assertEqual(Grammar("root x'41' (b /[a-z]/){0} x'42'\n"
+                                 "b    'b'\n").generate(), b"AB")
+
+    def test_same_output(self):
+        "test that optimized grammars generate the same output for a seed, with a limit and function arguments"
+
+        class Unoptimized(Grammar):
+            def optimize(self):
+                return {}
+
+        src = ("root   (a '\\n'){1,20}\n"
+               "a   1  f('aaaaaaaaaa') /[a-z]{0,5}/\n"
+               "    1  'b'{3} (c){2} a\n"
+               "    1  f(c c) 'd'{0}\n"
+               "c      'c' /x{2}/\n")
+        funcs = {"f": lambda arg: arg.upper()}
+        gmr, unoptimized = Grammar(src, limit=30, **funcs), Unoptimized(src, limit=30, **funcs)
+        self.assertGreater(gmr.optimize_stats["folded"], 0)
+        for seed in range(100):
+            self.assertEqual(gmr.generate(seed=seed), unoptimized.generate(seed=seed))
+
+    def test_inline(self):
+        "test that implicit concats are inlined and flattened, and unreachable symbols are removed"
+        with open("a.gmr", "w") as fd:
+            fd.write("used      'A' /[0-9]/\n"
+                     "unused    'B' /[0-9]/\n")
+        src = ("a      import('a.gmr')\n"
+               "root   b ('x' (a.used c)) (d) @3 e\n"
+               "b      1 (c)\n"
+               "       1 (d d)\n"
+               "c      /[cC]/\n"
+               "d      1 'd'\n"
+               "       1 'D'\n"
+               "e      1 ''\n"
+               "       1 (e (c))\n")
+        gmr = Grammar(src, limit=100)
+        self.assertNotIn("a.unused", gmr.symtab)
+        self.assertRegex(gmr.generate(start="d"), r"^[dD]$") # top-level symbols are kept
+        self.assertGreater(gmr.optimize_stats["inlined"], 0)
+        self.assertGreater(gmr.optimize_stats["flattened"], 0)
+        self.assertGreater(gmr.optimize_stats["removed"], 0)
+        self.assertLess(gmr.optimize_stats["symbols"][1], gmr.optimize_stats["symbols"][0])
+        root = gmr.symtab["root"]
+        self.assertEqual(len(root), 7)
+        self.assertEqual([root[0]] + root[2:4], ["b", "a.used", "c"])
+        self.assertEqual(gmr.symtab[root[1]].value, "x")
+        self.assertEqual(gmr.symtab["b"].values[0], "c")
+        for _ in range(20):
+            self.assertRegex(gmr.generate(), r"^([cC]|[dD]{2})xA[0-9][cC]([dD])\2[cC]*$")
+
+        class Unoptimized(Grammar):
+            def optimize(self):
+                return {}
+
+        unoptimized = Unoptimized(src, limit=100)
+        for seed in range(20):
+            self.assertEqual(gmr.generate(seed=seed), unoptimized.generate(seed=seed))
+        # with eval, any named symbol can be generated
+        gmr = Grammar("a      import('a.gmr')\n"
+                      "root   eval('a.unused') a.used\n")
+        self.assertRegex(gmr.generate(), r"^B[0-9]A[0-9]$")
+
+
+class Profile(TestCase):
+
+    def test_stats(self):
+        "test symbol counts and lengths recorded by the profiler"
+        gmr = Grammar("root   (a '\\n'){5} b\n"
+                      "a   1  'xy'\n"
+                      "    1  'yz' b\n"
+                      "b      /[0-9]{3}/\n")
+        for seed in range(5):
+            expected = gmr.generate(seed=seed)
+            profile = GenerationProfile(gmr)
+            self.assertEqual(gmr.generate(seed=seed, profile=profile), expected)
+            stats = profile.stats()
+            self.assertEqual(stats["root"]["count"], 1)
+            self.assertEqual(stats["root"]["length"], len(expected))
+            self.assertEqual(stats["a"]["count"], 5)
+            self.assertEqual(stats["b"]["count"], expected.count("yz") + 1)
+            self.assertEqual(stats["b"]["length"], 3 * stats["b"]["count"])
+            self.assertEqual(sum(stat["self_length"] for stat in stats.values()), len(expected))
+            for stat in stats.values():
+                self.assertLessEqual(stat["self_time"], stat["time"])
+            # flush chunks to check the profile is the same
+            chunked = GenerationProfile(gmr)
+            self.assertEqual("".join(gmr.generate_iter(chunk_size=2, seed=seed, profile=chunked)), expected)
+            self.assertEqual({name: stat["length"] for name, stat in chunked.stats().items()},
+                             {name: stat["length"] for name, stat in stats.items()})
+        profile = gmr.profile(10)
+        self.assertEqual(profile.stats()["a"]["count"], 50)
+        self.assertIn("root", profile.report())
+
+    def test_func_args(self):
+        "test profiling functions with symbol arguments, which are generated separately"
+        gmr = Grammar("root a{3}\n"
+                      "a    'x' rndint(1, b) f(b) 'y'\n"
+                      "b    1 '5'\n"
+                      "     1 '7' /[0-9]/\n", f=lambda arg: "(%s)" % arg)
+        expected = gmr.generate(seed=1)
+        profile = GenerationProfile(gmr)
+        self.assertEqual(gmr.generate(seed=1, profile=profile), expected)
+        stats = profile.stats()
+        self.assertEqual(stats["a"]["count"], 3)
+        self.assertEqual(stats["b"]["count"], 6)
+        self.assertEqual(stats["root"]["count"], 1)
+        self.assertIn(";a;", profile.collapsed())
+        self.assertEqual(gmr.profile(5).stats()["b"]["count"], 30)
+
+    def test_collapsed(self):
+        "test collapsed stack output of the profiler"
+        gmr = Grammar("root   node{3}\n"
+                      "node   '(' inner ')'\n"
+                      "inner  1 ''\n"
+                      "       1 /[a-z]/ node\n", limit=None)
+        # the output differs between python versions, so find one which recursed
+        for seed in range(100):
+            profile = GenerationProfile(gmr)
+            output = gmr.generate(seed=seed, profile=profile)
+            if "((" in output:
+                break
+        lines = profile.collapsed("length").splitlines()
+        self.assertEqual(sum(int(line.rsplit(" ", 1)[1]) for line in lines), len(output))
+        for line in lines:
+            self.assertTrue(line.startswith("root;"), line)
+        self.assertTrue(any(re.search(r";node;inner;.*;node;", line) for line in lines))
+        self.assertTrue(profile.collapsed().startswith("root"))
+        with self.assertRaises(ValueError):
+            profile.collapsed("count")
+
+
 class Parser(TestCase):
 
     def test_broken(self):
@@ -599,6 +971,13 @@ class Parser(TestCase):
                       "     'c'")
         self.assertEqual(gmr.generate(), "abc")
 
+    def test_broken_long(self):
+        "test a long definition broken over many lines"
+        n = 2000
+        gmr = Grammar("root " + " \\\n ".join("'%d' /[a]{1}/ (x|'y')" % i for i in range(n)) + "\n"
+                      "x    'x'")
+        self.assertRegex(gmr.generate(), r"^(\d+a[xy]){%d}$" % n)
+
     def test_comment_in_broken(self):
         "test that you can comment out a broken line"
         gmr = Grammar("root 'some broken ' \\\n"
@@ -639,12 +1018,151 @@ class Parser(TestCase):
                       "foo        'i0'", limit=10)
         self.assertLessEqual(len(gmr.generate()), 10)
 
+    def test_generate_many(self):
+        "test that generating many outputs at once resets state between outputs"
+        gmr = Grammar("root   id() (a) @1 @a\n"
+                      "a      /[0-9]{4}/")
+        results = gmr.generate_many(100)
+        self.assertEqual(len(results), 100)
+        for result in results:
+            self.assertRegex(result, r"^0([0-9]{4})\1\1$")
+        self.assertGreater(len(set(results)), 1)
+        gen = gmr.iter_many()
+        for _ in range(100):
+            self.assertRegex(next(gen), r"^0([0-9]{4})\1\1$")
+        self.assertEqual(list(gmr.iter_many(0)), [])
+        gmr = Grammar("root a 'B'\n"
+                      "a 'A'")
+        self.assertEqual(gmr.generate_many(3, start='a'), ['A', 'A', 'A'])
+
+    def test_unknown_start(self):
+        "test that generating from an undefined start symbol raises GenerationError"
+        gmr = Grammar("root 'A'")
+        with self.assertRaisesRegex(GenerationError, r"^start symbol u?'b' is not defined$"):
+            gmr.generate(start="b")
+        with self.assertRaisesRegex(GenerationError, r"^start symbol u?'b' is not defined$"):
+            list(gmr.iter_many(1, start="b"))
+        with self.assertRaisesRegex(GenerationError, r"^start symbol u?'b' is not defined$"):
+            list(gmr.generate_iter(start="b"))
+        with self.assertRaisesRegex(GenerationError, r"^start symbol u?'b' is not defined$"):
+            gmr.generate_parallel(1, workers=1, start="b")
+
+    def test_generate_parallel(self):
+        "test generating in parallel with deterministic seeds"
+        gmr = Grammar("root   (a) @1 filt(a)\n"
+                      "a      /[0-9]{8}/", filt=reverse)
+        results = list(gmr.generate_parallel(20, workers=2, seed=1234))
+        self.assertEqual([idx for (idx, _) in results], list(range(20)))
+        for idx, result in results:
+            self.assertRegex(result, r"^([0-9]{8})\1[0-9]{8}$")
+            self.assertEqual(gmr.generate(seed=Grammar.testcase_seed(1234, idx)), result)
+        self.assertGreater(len(set(result for (_, result) in results)), 1)
+        unordered = list(gmr.generate_parallel(20, workers=3, seed=1234, ordered=False))
+        self.assertEqual(sorted(unordered), results)
+        self.assertEqual([result for (_, result) in results], gmr.generate_many(20, seed=1234))
+        results = list(gmr.generate_parallel(4, workers=2, seed="abc"))
+        self.assertEqual([result for (_, result) in results], [gmr.generate(seed=Grammar.testcase_seed("abc", idx))
+                                                               for idx in range(4)])
+        with self.assertRaisesRegex(GenerationError, r"^ValueError.*\(testcase \d+\)$"):
+            list(Grammar("root rndint(2,1)").generate_parallel(2, workers=1))
+
+    def test_generate_iter(self):
+        "test generating output in chunks"
+        gmr = Grammar("root   (line '\\n'){1000}\n"
+                      "line   (a) ' ' @1 ' ' @a\n"
+                      "a      /[0-9]{8}/", limit=None)
+        expected = gmr.generate(seed=1)
+        chunks = list(gmr.generate_iter(chunk_size=1000, seed=1))
+        self.assertGreater(len(chunks), 10)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 1000)
+        self.assertEqual("".join(chunks), expected)
+        for line in expected.splitlines():
+            self.assertRegex(line, r"^([0-9]{8}) \1 [0-9]{8}$")
+        out = io.StringIO()
+        gmr.generate_to(out, chunk_size=1000, seed=1)
+        self.assertEqual(out.getvalue(), expected)
+
+    def test_seed(self):
+        "test that outputs are determined by the seed"
+        gram = ("root   (line '\\n'){10,100}\n"
+                "line   (a) ' ' @1 ' ' rndint(0,1000) ' ' rndflt(0,1) ' ' rndpow2(8,1) ' ' b<1,3> ' ' @a\n"
+                "a      /[0-9]{8}/\n"
+                "b    1 'x'\n"
+                "     1 'y'\n"
+                "     1 'z'\n")
+        gmr = Grammar(gram)
+        outputs = {}
+        for seed in range(10):
+            outputs[seed] = gmr.generate(seed=seed)
+        self.assertEqual(len(set(outputs.values())), 10)
+        random.seed(0)
+        gmr2 = Grammar(gram)
+        self.assertEqual(gmr.hash, gmr2.hash)
+        for seed in range(10):
+            self.assertEqual(gmr2.generate(seed=seed), outputs[seed])
+        # batch generation accepts the same seeds as generate()
+        self.assertEqual(list(gmr.iter_many(2, seed="abc")),
+                         [gmr.generate(seed=Grammar.testcase_seed("abc", idx)) for idx in range(2)])
+        self.assertNotEqual(Grammar(gram, limit=10).hash, gmr.hash)
+        self.assertNotEqual(Grammar(gram + "# changed\n").hash, gmr.hash)
+        # a generator version which could change outputs changes the hash
+        version = avalanche.core.CACHE_VERSION
+        avalanche.core.CACHE_VERSION += 1
+        try:
+            self.assertNotEqual(Grammar(gram).hash, gmr.hash)
+        finally:
+            avalanche.core.CACHE_VERSION = version
+
+    def test_threads(self):
+        "test generation from one Grammar in several threads at once"
+        gmr = Grammar("root   (line '\\n'){10,100}\n"
+                      "line   (a) ' ' @1 ' ' rndint(0,1000) ' ' b<1,3> ' ' @a\n"
+                      "a      /[0-9]{8}/\n"
+                      "b    1 'x'\n"
+                      "     1 'y'\n"
+                      "     1 'z'\n")
+        expected = [gmr.generate(seed=seed) for seed in range(40)]
+        results, rngs = [None] * len(expected), []
+
+        def worker(offset):
+            rngs.append(gmr.thread_rng())
+            for seed in range(offset, len(expected), 4):
+                results[seed] = gmr.generate(seed=seed)
+                gmr.generate()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, expected)
+        self.assertIs(gmr.thread_rng(), gmr.rng)
+        self.assertEqual(len(set(id(rng) for rng in rngs + [gmr.rng])), 5)
+
     def test_altstart(self):
         "test that starting symbols other than 'root' work"
         gmr = Grammar("root a 'B'\n"
                       "a 'A'")
         self.assertEqual(gmr.generate(start='a'), 'A')
 
+    def test_compile(self):
+        "test that the compiled generation plan covers the whole symtab"
+        gmr = Grammar("root a @a (b) @1\n"
+                      "a    'A' b\n"
+                      "b  1 'B'\n"
+                      "   1 a")
+        self.assertEqual(set(gmr._names), set(gmr.symtab))
+        for name, sym_id in gmr._ids.items():
+            self.assertEqual(gmr._names[sym_id], name)
+            self.assertIs(gmr._syms[sym_id], gmr.symtab[name])
+        self.assertEqual(gmr._args[gmr._ids["a"]], (gmr._ids["b"], gmr._ids["[text (line 2 #0)]"]))
+        self.assertTrue(gmr._flags[gmr._ids["a"]] & 2) # tracked
+        self.assertTrue(gmr._flags[gmr._ids["b"]] & 4) # recursive
+        self.assertFalse(gmr._flags[gmr._ids["[text (line 2 #0)]"]] & 1) # implicit
+        for _ in range(100):
+            self.assertRegex(gmr.generate(), r"^A+BA+B(A*B)\1$")
+
     def test_incomplete_sym_defn(self):
         "test incomplete symbol definitions raise ParseError"
         with self.assertRaisesRegex(ParseError, r'^Failed to parse definition.*\(line 2\)'):
@@ -700,6 +1218,9 @@ class Regexes(TestCase):
         "test for invalid range in a regex"
         with self.assertRaisesRegex(ParseError, r'^Empty range in regex'):
             Grammar('root /[+-*]/')
+        for defn in ("/[^ -~]/", "/[^ -~]{20}/"):
+            with self.assertRaisesRegex(ParseError, r'^Empty set in regex'):
+                Grammar("root %s" % defn)
 
     def test_2(self):
         "test that '.' works in a regex"
@@ -724,6 +1245,37 @@ class Regexes(TestCase):
             out = set(out)
         self.assertEqual(set(out), set(unichr_(c) for c in range(0x1f300, 0x1f600)))
 
+    def test_5(self):
+        "test '.' in more than one regex"
+        self.assertRegex(Grammar("root /a./ /./").generate(), r"^a[ -~]{2}$")
+
+    def test_6(self):
+        "test that repeats in a regex stop at the limit, like other repeats"
+        for _ in range(10):
+            self.assertEqual(Grammar("root 'x'{20} /a{3,50}b{0,9}/", limit=10).generate(), "x" * 20 + "aaa")
+            self.assertEqual(Grammar("root /a{20}b{0,9}c/", limit=10).generate(), "a" * 20 + "c")
+            self.assertRegex(Grammar("root /[0-9a-f]{32}/ /x?y{2}/", limit=10).generate(), r"^[0-9a-f]{32}yy$")
+        self.assertEqual(Grammar("root x'41' /b?/", limit=0).generate(), b"A")
+
+    def test_7(self):
+        "test inverse sets which overlap the end of the default alphabet"
+        for _ in range(100):
+            self.assertRegex(Grammar("root /[^x-\u00ff]/").generate(), r"^[ -w]$")
+            self.assertRegex(Grammar("root /[^a-z0-9 ]/").generate(), r"^[!-/:-`{-~]$")
+
+    def test_8(self):
+        "test long repeats of a character set, which are drawn in bulk"
+        gmr = Grammar("root /[a-c]{200}/ /[\u00e0-\u00ff]{20,40}/ /.{16}/")
+        counts = {"a": 0, "b": 0, "c": 0}
+        for _ in range(50):
+            result = gmr.generate()
+            self.assertRegex(result, "^[a-c]{200}[\u00e0-\u00ff]{20,40}[ -~]{16}$")
+            for char in result[:200]:
+                counts[char] += 1
+        for count in counts.values():
+            self.assertGreater(count, 3000)
+        self.assertEqual(gmr.generate(seed=1), gmr.generate(seed=1))
+
 
 
 class Repeats(TestCase):
@@ -885,6 +1437,22 @@ class Repeats(TestCase):
             lengths.add(len(result))
         self.assertEqual(len(lengths), 11)
 
+    def test_8(self):
+        "test that repeats stop at the limit between iterations, and don't expand all iterations up front"
+        for _ in range(20):
+            self.assertEqual(Grammar("root ('x' 'y'){10,100000}", limit=5).generate(), "xy" * 10)
+            self.assertIn(len(Grammar("root a{10,100000}\n"
+                                      "a 1 'x'\n"
+                                      "  1 'y'", limit=15).generate()), range(10, 16))
+        gmr = Grammar("root 'x'{100000}", limit=None)
+        gstate = _GenState(gmr)
+        gstate.reset(gmr._ids["root"])
+        depth = 0
+        for _ in gmr._expand(gstate, 1000):
+            depth = max(depth, len(gstate.symstack))
+        self.assertLess(depth, 10)
+        self.assertEqual(gstate.length, 100000)
+
 
 class References(TestCase):
 
@@ -966,6 +1534,133 @@ class References(TestCase):
         # more than a single reference should be used
         self.assertGreater(len(refs), 1, "Expecting more than a single reference be used")
 
+    def test_7(self):
+        "test references to nested instances, and to instances in chunks which were already flushed"
+        gmr = Grammar("root   (node '\\n'){20} ('=' @node '\\n'){20}\n"
+                      "node   '<' (tag) '>' inner '</' @1 '>'\n"
+                      "tag    /[a-z]{1,3}/\n"
+                      "inner  1 ''\n"
+                      "       1 node\n"
+                      "       1 'x' @node\n", limit=None)
+        for seed in range(10):
+            expected = gmr.generate(seed=seed)
+            self.assertEqual("".join(gmr.generate_iter(chunk_size=8, seed=seed)), expected)
+            defs, refs = expected.split("=", 1)
+            for ref in refs.split("="):
+                self.assertRegex(ref, r"^<([a-z]+)>.*</\1>\n$")
+                self.assertIn(ref.strip(), defs)
+
+    def test_8(self):
+        "test that max_instances limits the instances kept for references"
+        grammar = ("root   (id '\\n'){100} '-' (@id '\\n'){100}\n"
+                   "id     'id' /[0-9]{8}/\n")
+        gmr = Grammar(grammar, max_instances=5)
+        self.assertNotEqual(gmr.hash, Grammar(grammar).hash)
+        for seed in range(10):
+            defs, refs = gmr.generate(seed=seed).split("-")
+            defs, refs = set(defs.split()), set(refs.split())
+            self.assertEqual(len(defs), 100)
+            self.assertLessEqual(len(refs), 5)
+            self.assertTrue(refs <= defs)
+        for max_instances in (0, -1):
+            with self.assertRaisesRegex(IntegrityError, r"max_instances must be at least 1"):
+                Grammar(grammar, max_instances=max_instances)
+
+
+class Serve(TestCase):
+    def test_0(self):
+        "test that the prefetch queue is bounded"
+        testcases = PrefetchQueue(Grammar("root /[a-z]{10}/"), size=4)
+        try:
+            for _ in range(50):
+                if testcases.generated >= 5:
+                    break
+                threading.Event().wait(0.01)
+            threading.Event().wait(0.05)
+            self.assertEqual(testcases.generated, 5) # 4 queued, one waiting to be put
+            self.assertRegex(testcases.get(), r"^[a-z]{10}$")
+            stats = testcases.stats()
+            self.assertEqual(stats["served"], 1)
+            self.assertGreaterEqual(stats["p99_ms"], stats["p50_ms"])
+        finally:
+            testcases.stop()
+
+    def test_1(self):
+        "test serving testcases over http"
+        testcases = PrefetchQueue(Grammar("root /[a-z]{10}/"), size=4)
+        server = make_server(testcases, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d/" % server.server_address[1]
+            outputs = [urlopen(url).read().decode("utf-8") for _ in range(10)]
+            for output in outputs:
+                self.assertRegex(output, r"^[a-z]{10}$")
+            self.assertGreater(len(set(outputs)), 1)
+            stats = json.loads(urlopen(url + "stats").read().decode("utf-8"))
+            self.assertEqual(stats["served"], 10)
+            self.assertEqual(stats["errors"], 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            testcases.stop()
+
+    @unittest.skipIf(not hasattr(socket, "AF_UNIX"), "unix sockets are not supported")
+    def test_unix(self):
+        "test serving testcases over a unix socket, and that generation errors are logged"
+
+        class _Records(logging.Handler):
+
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(record.getMessage())
+
+        calls = []
+
+        def fail(value):
+            # only the first testcase fails, so the worker doesn't log more errors while the test runs
+            calls.append(value)
+            if len(calls) == 1:
+                raise RuntimeError("no testcase")
+            return value
+
+        handler = _Records()
+        handler.setLevel(logging.ERROR)
+        logging.getLogger("avalanche.serve").addHandler(handler)
+        testcases = PrefetchQueue(Grammar("root fail('x')", fail=fail), size=1)
+        server = make_server(testcases, unix=os.path.join(self.tmpd, "a.sock"))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(os.path.join(self.tmpd, "a.sock"))
+            self.assertEqual(sock.recv(1), b"") # closed without a testcase
+            sock.close()
+            self.assertEqual(testcases.stats()["errors"], 1)
+            self.assertEqual(len(handler.records), 1, handler.records)
+            self.assertIn("no testcase", handler.records[0])
+        finally:
+            logging.getLogger("avalanche.serve").removeHandler(handler)
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            testcases.stop()
+
+    def test_unix_unsupported(self):
+        "test that asking for a unix socket where they aren't supported is a clear error"
+        testcases = PrefetchQueue(Grammar("root 'a'"), size=1)
+        unix_server, avalanche.serve._UnixServer = avalanche.serve._UnixServer, None # pylint: disable=protected-access
+        try:
+            with self.assertRaisesRegex(ValueError, r"not supported"):
+                make_server(testcases, unix="a.sock")
+        finally:
+            avalanche.serve._UnixServer = unix_server # pylint: disable=protected-access
+            testcases.stop()
+
 
 class SparseList_(TestCase):
 
@@ -981,7 +1676,7 @@ class SparseList_(TestCase):
         self.assertEqual(lst[2], 5)
         self.assertEqual(lst[3], 7)
         self.assertEqual(lst[4], 8)
-        self.assertEqual(len(lst._data), 3)
+        self.assertEqual(len(lst.ranges()), 3)
 
     def test_1(self):
         "test sorted order of sparse lists"
@@ -993,20 +1688,20 @@ class SparseList_(TestCase):
         self.assertEqual(lst[0], 1)
         self.assertEqual(lst[1], 3)
         self.assertEqual(lst[2], 5)
-        self.assertEqual(len(lst._data), 3)
+        self.assertEqual(len(lst.ranges()), 3)
 
     def test_2(self):
         "test optimization of sparse lists"
         lst = SparseList()
         lst.add(6)
         lst.add(4)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         lst.add(5)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.add(3)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.add(7)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         self.assertEqual(len(lst), 5)
         self.assertEqual(lst[0], 3)
         self.assertEqual(lst[1], 4)
@@ -1019,81 +1714,81 @@ class SparseList_(TestCase):
         lst = SparseList()
         lst.add(1)
         lst.add(3)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         lst.remove(2)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         self.assertEqual(len(lst), 2)
         self.assertEqual(lst[0], 1)
         self.assertEqual(lst[1], 3)
 
         lst = SparseList()
         lst.add(1)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.remove(1)
-        self.assertEqual(len(lst._data), 0)
+        self.assertEqual(len(lst.ranges()), 0)
         self.assertEqual(len(lst), 0)
 
         lst = SparseList()
         lst.add(1)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.add(3)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         lst.remove(1, 3)
-        self.assertEqual(len(lst._data), 0)
+        self.assertEqual(len(lst.ranges()), 0)
         self.assertEqual(len(lst), 0)
 
         lst = SparseList()
         lst.add(1, 2)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.remove(2)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         self.assertEqual(len(lst), 1)
         self.assertEqual(lst[0], 1)
 
         lst = SparseList()
         lst.add(1, 3)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.add(5)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         lst.remove(2, 5)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         self.assertEqual(len(lst), 1)
         self.assertEqual(lst[0], 1)
 
         lst = SparseList()
         lst.add(1, 2)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.remove(1)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         self.assertEqual(len(lst), 1)
         self.assertEqual(lst[0], 2)
 
         lst = SparseList()
         lst.add(1)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.add(3, 5)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         lst.remove(1, 4)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         self.assertEqual(len(lst), 1)
         self.assertEqual(lst[0], 5)
 
         lst = SparseList()
         lst.add(1, 3)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.remove(2)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         self.assertEqual(len(lst), 2)
         self.assertEqual(lst[0], 1)
         self.assertEqual(lst[1], 3)
 
         lst = SparseList()
         lst.add(1, 3)
-        self.assertEqual(len(lst._data), 1)
+        self.assertEqual(len(lst.ranges()), 1)
         lst.add(24, 26)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         lst.remove(2, 25)
-        self.assertEqual(len(lst._data), 2)
+        self.assertEqual(len(lst.ranges()), 2)
         self.assertEqual(len(lst), 2)
         self.assertEqual(lst[0], 1)
         self.assertEqual(lst[1], 26)
@@ -1134,6 +1829,52 @@ class SparseList_(TestCase):
             lst = SparseList()
             lst.remove(2, 1)
 
+    def test_5(self):
+        "test indexing sparse lists with many ranges, through add, remove and -="
+        rnd = random.Random(0)
+        lst, expected = SparseList(), set()
+        for _ in range(300):
+            a = rnd.randint(0, 5000)
+            b = a + rnd.randint(0, 10)
+            if rnd.random() < 0.7:
+                if not expected & set(range(a, b + 1)):
+                    lst.add(a, b)
+                    expected |= set(range(a, b + 1))
+            else:
+                lst.remove(a, b)
+                expected -= set(range(a, b + 1))
+            if rnd.random() < 0.2:
+                self.assertEqual([lst[i] for i in range(len(lst))], sorted(expected))
+        sub = SparseList()
+        sub.add(1000, 3000)
+        copy = SparseList(lst)
+        copy -= sub
+        self.assertEqual([lst[i] for i in range(len(lst))], sorted(expected))
+        self.assertEqual([copy[i] for i in range(len(copy))], sorted(expected - set(range(1000, 3001))))
+        self.assertEqual(list(copy), sorted(expected - set(range(1000, 3001))))
+
+    def test_6(self):
+        "test building sparse lists from many ranges at once"
+        lst = SparseList.from_ranges([(20, 30), (1, 5), (6, 9), (40, 40)])
+        self.assertEqual(lst.ranges(), [(1, 9), (20, 30), (40, 40)])
+        self.assertEqual(len(lst), 21)
+        self.assertEqual(lst[9], 20)
+        lst.add_ranges([(10, 19), (50, 60)])
+        self.assertEqual(lst.ranges(), [(1, 30), (40, 40), (50, 60)])
+        self.assertEqual(len(lst), 42)
+        with self.assertRaisesRegex(ValueError, r"^5 is already present in the list$"):
+            SparseList.from_ranges([(1, 5), (5, 6)])
+        with self.assertRaisesRegex(ValueError, r"^Only forward intervals are supported \(a <= b\)$"):
+            SparseList.from_ranges([(2, 1)])
+        # removing past the last range
+        lst.remove(55, 100)
+        lst.remove(0, 3)
+        self.assertEqual(lst.ranges(), [(4, 30), (40, 40), (50, 54)])
+        self.assertEqual(len(lst), len(list(lst)))
+        lst.remove(0, 100)
+        self.assertEqual(lst.ranges(), [])
+        self.assertEqual(len(lst), 0)
+
 
 class Strings(TestCase):
 
@@ -1232,6 +1973,28 @@ class Script(TestCase):
         with open('a.txt', 'r') as fd:
             self.assertEqual(fd.read(), "A")
 
+    def test_seed(self):
+        "test generation with a seed from main"
+        with open('a.gmr', 'w') as fd:
+            fd.write('root /[a-z]{100}/')
+        outputs = []
+        for out_fn in ("a.txt", "b.txt", "c.txt"):
+            main(["a.gmr", out_fn, "-s", "1" if out_fn != "c.txt" else "2"])
+            with open(out_fn) as fd:
+                outputs.append(fd.read())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertNotEqual(outputs[0], outputs[2])
+
+    def test_profile(self):
+        "test profiling from main"
+        with open('a.gmr', 'w') as fd:
+            fd.write('root /[a-z]{100}/')
+        main(["a.gmr", "a.txt", "-s", "1", "--flamegraph", "a.stacks"])
+        with open("a.txt") as fd:
+            self.assertEqual(len(fd.read()), 100)
+        with open("a.stacks") as fd:
+            self.assertRegex(fd.read(), r"(?m)^root \d+$")
+
     def test_03(self):
         "test unicode I/O with main"
         test_strings = [